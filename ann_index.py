@@ -0,0 +1,160 @@
+"""
+Approximate nearest-neighbour search for campus-scale identification
+IVF (inverted file) index in pure NumPy: a spherical k-means coarse
+quantizer splits the gallery into lists and each query only scans the
+nprobe lists whose centroids are closest to it.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import FACE_ANN_ENABLED, FACE_ANN_NLIST, FACE_ANN_NPROBE, FACE_ANN_MIN_GALLERY_SIZE
+
+
+class IVFIndex:
+    def __init__(self, nlist=FACE_ANN_NLIST, nprobe=FACE_ANN_NPROBE, n_iter=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+        self.list_of_row = np.empty(0, dtype=np.int64)
+        self.trained_size = 0
+        self.generation = None
+
+    def build(self, gallery, generation=None):
+        """Train the coarse quantizer on a FaceGallery's rows and fill the lists"""
+        n = len(gallery)
+        nlist = self.nlist or int(round(4 * np.sqrt(n)))
+        nlist = max(1, min(nlist, n))
+        rng = np.random.default_rng(self.seed)
+
+        # Train on a sample; k-means quality saturates well before the full gallery
+        sample_size = min(n, 64 * nlist)
+        sample = gallery.rows(np.sort(rng.choice(n, sample_size, replace=False)))
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = sums / (np.linalg.norm(sums, axis=1, keepdims=True) + 1e-8)
+
+        self.centroids = centroids.astype(np.float32)
+        self.trained_size = n
+        self.list_of_row = self._assign(gallery)
+        order = np.argsort(self.list_of_row, kind='stable')
+        bounds = np.searchsorted(self.list_of_row[order], np.arange(nlist + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(nlist)]
+        self.generation = generation
+        return self
+
+    def _assign(self, gallery, block=8192):
+        """Nearest centroid for every row, computed in blocks to bound memory"""
+        assign = np.empty(len(gallery), dtype=np.int64)
+        for start in range(0, len(gallery), block):
+            chunk = gallery.rows(slice(start, start + block))
+            assign[start:start + block] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return assign
+
+    def copy(self):
+        """Copy that can be add()-ed to while the original is searched (list arrays are shared until replaced)"""
+        clone = IVFIndex(self.nlist, self.nprobe, self.n_iter, self.seed)
+        clone.centroids = self.centroids
+        clone.lists = list(self.lists)
+        clone.list_of_row = self.list_of_row.copy()
+        clone.trained_size = self.trained_size
+        clone.generation = self.generation
+        return clone
+
+    def add(self, row, embedding):
+        """Insert or move a single gallery row (embedding must be L2-normalized)"""
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        if row >= len(self.list_of_row):
+            grown = np.full(row + 1, -1, dtype=np.int64)
+            grown[:len(self.list_of_row)] = self.list_of_row
+            self.list_of_row = grown
+        old = self.list_of_row[row]
+        if old >= 0:
+            self.lists[old] = self.lists[old][self.lists[old] != row]
+        new = int(np.argmax(self.centroids @ embedding))
+        self.lists[new] = np.append(self.lists[new], row)
+        self.list_of_row[row] = new
+
+    def search(self, gallery, queries, k=2, nprobe=None):
+        """Return (rows, scores) of the k best candidates per query, padded with -1"""
+        queries = np.atleast_2d(queries)
+        nprobe = max(1, min(nprobe or self.nprobe, len(self.lists)))
+        rows = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        scores = np.full((queries.shape[0], k), -1.0, dtype=np.float32)
+
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([self.lists[p] for p in probes[i]])
+            if not len(candidates):
+                continue
+            candidate_scores = gallery.rows(candidates) @ query
+            top = min(k, len(candidates))
+            best = np.argpartition(-candidate_scores, top - 1)[:top]
+            best = best[np.argsort(-candidate_scores[best])]
+            rows[i, :top] = candidates[best]
+            scores[i, :top] = candidate_scores[best]
+        return rows, scores
+
+
+# Site-wide index over the gallery store, kept in step with it by apply_gallery_delta
+_campus_index = None
+
+def get_campus_gallery(store=None):
+    """FaceGallery over every enrolled student, ANN-backed above the size cutoff"""
+    global _campus_index
+    if store is None:
+        from gallery_store import get_gallery_store
+        store = get_gallery_store()
+
+    snapshot = store.snapshot()
+    gallery = snapshot.gallery()
+    if not FACE_ANN_ENABLED or len(gallery) < FACE_ANN_MIN_GALLERY_SIZE:
+        return gallery
+
+    index = _campus_index
+    if index is None or index.generation != snapshot.generation:
+        index = _campus_index = IVFIndex().build(gallery, snapshot.generation)
+        store.subscribe(apply_gallery_delta)
+    gallery.index = index
+    return gallery
+
+
+def apply_gallery_delta(delta):
+    """Gallery store listener: insert changed rows instead of rebuilding the campus index
+
+    The rows go into a copy that is swapped in afterwards, so searches
+    already running keep the index they started with. Falls back to a
+    rebuild on the next get_campus_gallery() call when a version was
+    skipped, rows were removed or moved, the templates changed dimension,
+    or the gallery has outgrown the trained quantizer fourfold.
+    """
+    global _campus_index
+    index = _campus_index
+    if index is None or index.generation == delta['generation']:
+        return
+    if (index.generation != delta['previous_generation'] or delta['removed'] or delta['rows_moved']
+            or delta['size'] > 4 * index.trained_size or delta['gallery'].dim != index.centroids.shape[1]):
+        _campus_index = None
+        return
+    index = index.copy()
+    rows = [delta['rows'][student_id] for student_id in delta['changed']]
+    for row, embedding in zip(rows, delta['gallery'].rows(rows)):
+        index.add(row, embedding)
+    index.generation = delta['generation']
+    _campus_index = index
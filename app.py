@@ -1,3 +1,6 @@
+import time
+_script_start = time.perf_counter()
+
 import streamlit as st
 import sys
 import os
@@ -5,16 +8,18 @@ import os
 # Ensure we import from the local config, not cv2's config
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-# Use wrapper to handle headless environment
-from cv2_wrapper import cv2
-import numpy as np
 from datetime import datetime, date, timedelta
 import pandas as pd
 from pathlib import Path
 import sqlite3
 
+from config import FACE_SIMILARITY_THRESHOLD, FACE_GROUP_SIMILARITY_THRESHOLD, FACE_GROUP_MIN_FACE_SIZE
 import database as db
-from face_recognition_module import get_face_engine, match_face_to_students
+from face_recognition_module import get_face_engine, match_face_to_students, start_engine_warmup, engine_status
+from section_gallery import get_section_gallery
+from face_quality import enrollment_issues
+from image_ingest import decode_image
+from metrics import span, get_metrics
 from ai_integration import get_ai_assistant
 
 # ==================== PAGE CONFIG ====================
@@ -37,6 +42,11 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+@st.cache_resource
+def _startup_clock():
+    """Process-wide record of the first page run, kept across reruns"""
+    return {'started': _script_start, 'first_render': None}
+
 # ==================== SESSION STATE ====================
 def init_session():
     if 'logged_in' not in st.session_state:
@@ -46,8 +56,8 @@ def init_session():
         st.session_state.student_data = None
         st.session_state.instructor_data = None
     
-    if 'face_engine' not in st.session_state:
-        st.session_state.face_engine = get_face_engine()
+    # Models load on a background thread; pages check face_engine_ready()
+    start_engine_warmup()
     
     if 'ai_assistant' not in st.session_state:
         st.session_state.ai_assistant = get_ai_assistant()
@@ -57,6 +67,45 @@ def init_session():
 
 init_session()
 
+# Longest side of upload previews
+PREVIEW_SIZE = 640
+
+def face_engine_ready():
+    """Whether the face engine has finished loading; shows its loading state otherwise"""
+    status = engine_status()
+    if status['state'] == 'ready':
+        st.session_state.face_engine = get_face_engine()
+        return True
+    if status['state'] == 'failed':
+        st.error(f"❌ Face recognition unavailable: {status['error']}")
+    else:
+        st.info(f"⏳ Face recognition model loading... ({status['elapsed']:.0f}s) - refresh in a moment")
+    return False
+
+def face_issues(detections, enrollment=False):
+    """Quality problems of the first detected face, for messages to the user"""
+    quality = detections[0].get('quality') if detections else None
+    if quality is None:
+        return "please try again"
+    return ', '.join(enrollment_issues(quality) if enrollment else quality['issues']) or "please try again"
+
+def save_face_photo(student_id, uploaded_file):
+    """Keep the original upload as the student's profile photo; returns its path"""
+    Path("face_images").mkdir(exist_ok=True)
+    path = f"face_images/student_{student_id}{Path(uploaded_file.name).suffix.lower() or '.jpg'}"
+    Path(path).write_bytes(uploaded_file.getvalue())
+    return path
+
+def show_upload(uploaded_file, **image_kwargs):
+    """Preview an uploaded photo; False (with an error shown) when it cannot be used"""
+    # Reduced JPEG decode at display size, shown as BGR without an RGB copy
+    image, _ = decode_image(uploaded_file.getvalue(), PREVIEW_SIZE)
+    if image is None:
+        st.error("❌ Could not read this photo (unsupported format or too large)")
+        return False
+    st.image(image, channels="BGR", **image_kwargs)
+    return True
+
 # ==================== FACE ATTENDANCE KIOSK ====================
 def face_attendance_kiosk():
     """Standalone face attendance kiosk - no login required"""
@@ -131,6 +180,8 @@ def face_attendance_kiosk():
     
     with col2:
         st.markdown("### 📷 Face Recognition")
+        if not face_engine_ready():
+            return
         
         # Check if face registered
         face_encoding = st.session_state.face_engine.load_face_encoding(student_id)
@@ -142,20 +193,20 @@ def face_attendance_kiosk():
             uploaded_file = st.file_uploader("Upload face photo", type=['jpg', 'jpeg', 'png'], key="kiosk_upload")
             
             if uploaded_file:
-                image = cv2.imdecode(np.frombuffer(uploaded_file.read(), np.uint8), cv2.IMREAD_COLOR)
-                st.image(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), caption="Your Photo", use_column_width=True)
+                usable = show_upload(uploaded_file, caption="Your Photo", use_column_width=True)
                 
-                if st.button("✅ Register Face", use_container_width=True, key="kiosk_register"):
+                if usable and st.button("✅ Register Face", use_container_width=True, key="kiosk_register"):
                     with st.spinner("🔍 Processing..."):
-                        detections = st.session_state.face_engine.detect_faces(image)
-                        if detections:
-                            embedding = detections[0]['embedding']
-                            st.session_state.face_engine.save_face_encoding(student_id, embedding)
-                            Path("face_images").mkdir(exist_ok=True)
-                            cv2.imwrite(f"face_images/student_{student_id}.jpg", image)
-                            db.update_student_face(student_id, f"face_images/student_{student_id}.jpg")
+                        with span('flow', flow='registration'):
+                            _, detections = st.session_state.face_engine.detect_encoded(uploaded_file.getvalue(), max_faces=1)
+                        face = detections[0] if detections else None
+                        if face is not None and face['embedding'] is not None and \
+                                st.session_state.face_engine.save_face_encoding(student_id, face['embedding'], face.get('quality')):
+                            db.update_student_face(student_id, save_face_photo(student_id, uploaded_file))
                             st.markdown('<div class="success-box">✅ Face Registered!</div>', unsafe_allow_html=True)
                             st.rerun()
+                        elif face is not None:
+                            st.markdown(f'<div class="error-box">❌ Photo Not Usable: {face_issues(detections, enrollment=True)}</div>', unsafe_allow_html=True)
                         else:
                             st.markdown('<div class="error-box">❌ No Face Detected</div>', unsafe_allow_html=True)
         else:
@@ -167,12 +218,12 @@ def face_attendance_kiosk():
             camera_input = st.camera_input("📷 Position your face in camera", key="kiosk_camera")
             
             if camera_input:
-                image = cv2.imdecode(np.frombuffer(camera_input.read(), np.uint8), cv2.IMREAD_COLOR)
-                
                 with st.spinner("🔍 Analyzing face..."):
-                    detections = st.session_state.face_engine.detect_faces(image)
+                    # Cached by image content, so reruns (e.g. clicking Mark) skip inference
+                    with span('flow', flow='checkin'):
+                        _, detections = st.session_state.face_engine.detect_encoded(camera_input.getvalue(), max_faces=1)
                     
-                    if detections:
+                    if detections and detections[0]['embedding'] is not None:
                         detected_embedding = detections[0]['embedding']
                         confidence = st.session_state.face_engine.compare_faces(face_encoding, detected_embedding)
                         
@@ -182,14 +233,14 @@ def face_attendance_kiosk():
                         with col_r1:
                             st.metric("🎯 Confidence", f"{confidence*100:.1f}%")
                         with col_r2:
-                            status = "✅ MATCH" if confidence >= 0.6 else "❌ NO MATCH"
+                            status = "✅ MATCH" if confidence >= FACE_SIMILARITY_THRESHOLD else "❌ NO MATCH"
                             st.metric("Status", status)
                         with col_r3:
                             st.metric("📸 Faces", len(detections))
                         
                         st.markdown("---")
                         
-                        if confidence >= 0.6:
+                        if confidence >= FACE_SIMILARITY_THRESHOLD:
                             # Check if already marked
                             today = date.today()
                             existing = db.execute_query(
@@ -205,7 +256,9 @@ def face_attendance_kiosk():
                                     st.markdown('<div class="success-box"><strong>✅ SUCCESS!</strong><br>Attendance Marked<br>Confidence: ' + f"{confidence*100:.1f}%" + '<br>Time: ' + str(datetime.now().strftime("%H:%M:%S")) + '</div>', unsafe_allow_html=True)
                                     st.balloons()
                         else:
-                            st.markdown(f'<div class="error-box"><strong>❌ SORRY, NOT MATCHED</strong><br>Confidence: {confidence*100:.1f}% (Need 60%+)<br>Please try again with better lighting</div>', unsafe_allow_html=True)
+                            st.markdown(f'<div class="error-box"><strong>❌ SORRY, NOT MATCHED</strong><br>Confidence: {confidence*100:.1f}% (Need {FACE_SIMILARITY_THRESHOLD*100:.0f}%+)<br>Please try again with better lighting</div>', unsafe_allow_html=True)
+                    elif detections:
+                        st.markdown(f'<div class="error-box">❌ Face Not Clear ({face_issues(detections)}) - Please try again</div>', unsafe_allow_html=True)
                     else:
                         st.markdown('<div class="error-box">❌ No Face Detected - Please try again</div>', unsafe_allow_html=True)
 
@@ -426,7 +479,7 @@ def student_portal():
         
         if not enrollments:
             st.warning("⚠️ You are not enrolled in any courses yet")
-        else:
+        elif face_engine_ready():
             face_encoding = st.session_state.face_engine.load_face_encoding(student_id)
             
             if face_encoding is None:
@@ -457,12 +510,12 @@ def student_portal():
                         camera_input = st.camera_input("Take a photo to mark attendance")
                         
                         if camera_input:
-                            image = cv2.imdecode(np.frombuffer(camera_input.read(), np.uint8), cv2.IMREAD_COLOR)
-                            
                             with st.spinner("🔍 Analyzing face..."):
-                                detections = st.session_state.face_engine.detect_faces(image)
+                                # Cached by image content, so reruns (e.g. clicking Mark) skip inference
+                                with span('flow', flow='checkin'):
+                                    _, detections = st.session_state.face_engine.detect_encoded(camera_input.getvalue(), max_faces=1)
                                 
-                                if detections:
+                                if detections and detections[0]['embedding'] is not None:
                                     detected_embedding = detections[0]['embedding']
                                     confidence = st.session_state.face_engine.compare_faces(face_encoding, detected_embedding)
                                     
@@ -475,8 +528,7 @@ def student_portal():
                                         st.metric("🎯 Match Confidence", f"{confidence*100:.1f}%")
                                     
                                     with col_res2:
-                                        threshold = 0.6
-                                        if confidence >= threshold:
+                                        if confidence >= FACE_SIMILARITY_THRESHOLD:
                                             st.metric("✅ Status", "MATCH")
                                         else:
                                             st.metric("❌ Status", "NO MATCH")
@@ -486,7 +538,7 @@ def student_portal():
                                     
                                     st.markdown("---")
                                     
-                                    if confidence >= 0.6:
+                                    if confidence >= FACE_SIMILARITY_THRESHOLD:
                                         st.success(f"✅ Face matched with {confidence*100:.1f}% confidence!")
                                         
                                         today = date.today()
@@ -503,8 +555,11 @@ def student_portal():
                                                 st.success(f"✅ Attendance marked successfully!")
                                                 st.balloons()
                                     else:
-                                        st.warning(f"⚠️ Face match confidence is {confidence*100:.1f}% (minimum required: 60%)")
+                                        st.warning(f"⚠️ Face match confidence is {confidence*100:.1f}% (minimum required: {FACE_SIMILARITY_THRESHOLD*100:.0f}%)")
                                         st.info("💡 Try taking another photo with better lighting or closer to the camera")
+                                elif detections:
+                                    st.error(f"❌ Face not clear enough: {face_issues(detections)}")
+                                    st.info("💡 Move closer, face the camera and hold still")
                                 else:
                                     st.error("❌ No face detected in the image")
                                     st.info("💡 Make sure your face is clearly visible in the camera")
@@ -551,21 +606,21 @@ def student_portal():
         col1, col2 = st.columns(2)
         with col1:
             uploaded_file = st.file_uploader("Upload face photo", type=['jpg', 'jpeg', 'png'])
-            if uploaded_file:
-                image = cv2.imdecode(np.frombuffer(uploaded_file.read(), np.uint8), cv2.IMREAD_COLOR)
-                st.image(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), caption="Your Photo")
+            if uploaded_file and face_engine_ready():
+                usable = show_upload(uploaded_file, caption="Your Photo")
                 
-                if st.button("✅ Register Face", use_container_width=True):
+                if usable and st.button("✅ Register Face", use_container_width=True):
                     with st.spinner("Processing..."):
-                        detections = st.session_state.face_engine.detect_faces(image)
-                        if detections:
-                            embedding = detections[0]['embedding']
-                            st.session_state.face_engine.save_face_encoding(student_id, embedding)
-                            Path("face_images").mkdir(exist_ok=True)
-                            cv2.imwrite(f"face_images/student_{student_id}.jpg", image)
-                            db.update_student_face(student_id, f"face_images/student_{student_id}.jpg")
+                        with span('flow', flow='registration'):
+                            _, detections = st.session_state.face_engine.detect_encoded(uploaded_file.getvalue(), max_faces=1)
+                        face = detections[0] if detections else None
+                        if face is not None and face['embedding'] is not None and \
+                                st.session_state.face_engine.save_face_encoding(student_id, face['embedding'], face.get('quality')):
+                            db.update_student_face(student_id, save_face_photo(student_id, uploaded_file))
                             st.success("✅ Face registered successfully!")
                             st.info("You can now use face recognition for attendance in the 'Face Attendance' tab")
+                        elif face is not None:
+                            st.error(f"❌ Photo not usable for registration: {face_issues(detections, enrollment=True)}")
                         else:
                             st.error("❌ No face detected")
         
@@ -584,9 +639,12 @@ def student_portal():
             
             st.markdown("---")
             st.markdown("#### ℹ️ Face Recognition Info")
-            engine_info = st.session_state.face_engine.get_engine_info()
-            st.write(f"**Engine:** {engine_info['engine']}")
-            st.write(f"**Status:** Ready for registration")
+            if engine_status()['state'] == 'ready':
+                engine_info = get_face_engine().get_engine_info()
+                st.write(f"**Engine:** {engine_info['engine']}")
+                st.write(f"**Status:** Ready for registration")
+            else:
+                st.write(f"**Status:** Model {engine_status()['state']}")
 
 # ==================== INSTRUCTOR PORTAL ====================
 def instructor_portal():
@@ -716,32 +774,28 @@ def instructor_portal():
                 section = st.selectbox("Section", sections, format_func=lambda x: f"Section {x[2]}", key="face_s")
                 
                 st.markdown("---")
-                enrollments = db.get_enrollments_by_section(section[0])
-                student_encodings = {}
-                student_map = {}
-                
-                for enrollment in enrollments:
-                    student_id = enrollment[1]
-                    encoding = st.session_state.face_engine.load_face_encoding(student_id)
-                    if encoding is not None:
-                        student_encodings[student_id] = encoding
-                        student = db.get_student(student_id)
-                        if student:
-                            student_map[student_id] = student
+                # Compiled once per section, refreshed on enrollment/face changes
+                section_gallery = get_section_gallery(section[0])
+                student_encodings = section_gallery.gallery
+                student_map = section_gallery.students
                 
-                if not student_encodings:
+                if not len(student_encodings):
                     st.warning("⚠️ No registered faces")
                 else:
                     st.info(f"✅ Ready: {len(student_encodings)} students")
                     camera_input = st.camera_input("📷 Take photo")
                     
-                    if camera_input:
-                        image = cv2.imdecode(np.frombuffer(camera_input.read(), np.uint8), cv2.IMREAD_COLOR)
+                    if camera_input and face_engine_ready():
                         with st.spinner("🔍 Recognizing..."):
-                            matches = match_face_to_students(image, student_encodings, threshold=0.5)
+                            with span('flow', flow='group_recognition'):
+                                matches = match_face_to_students(camera_input.getvalue(), student_encodings, threshold=FACE_GROUP_SIMILARITY_THRESHOLD, min_face_size=FACE_GROUP_MIN_FACE_SIZE)
                         
                         if matches:
                             st.success(f"✅ Found {len(matches)} face(s)")
+                            if st.button(f"✅ Mark All Matched ({len(matches)})", key=f"mark_all_{section[0]}", use_container_width=True):
+                                result = db.mark_attendance_bulk(section[0], [(m['student_id'], m['similarity']) for m in matches])
+                                st.success(f"✅ Marked {result['inserted']} new, {result['updated']} updated, "
+                                           f"{result['skipped']} skipped (already marked or not enrolled)")
                             for match in matches:
                                 student_id = match['student_id']
                                 student = student_map.get(student_id)
@@ -861,13 +915,49 @@ def admin_portal():
         if st.button("🔄 Check System"):
             checks = {
                 'Database': True,
-                'Face Engine': True,
+                'Face Engine': engine_status()['state'] == 'ready',
                 'AI Assistant': True,
                 'Storage': True
             }
             for check, status in checks.items():
                 emoji = "✅" if status else "❌"
                 st.write(f"{emoji} {check}")
+        
+        clock = _startup_clock()
+        warmup = engine_status()
+        col1, col2 = st.columns(2)
+        with col1:
+            if clock['first_render'] is not None:
+                st.metric("⏱️ Cold Start to First Page", f"{clock['first_render']:.2f}s")
+        with col2:
+            if warmup['seconds'] is not None:
+                st.metric(f"🧠 Model Warm-up ({warmup['state']})", f"{warmup['seconds']:.2f}s")
+            else:
+                st.metric("🧠 Model Warm-up", f"{warmup['state']} ({warmup['elapsed']:.0f}s)")
+        if warmup['state'] == 'ready':
+            cache = get_face_engine().detection_cache.stats()
+            st.caption(f"Detection cache: {cache['hits']} hits / {cache['misses']} misses, "
+                       f"{cache['entries']} images ({cache['bytes'] / 2**20:.1f} MB)")
+        
+        st.markdown("#### ⏱️ Stage Latency")
+        stage_metrics = get_metrics().snapshot()
+        if stage_metrics:
+            latency_df = pd.DataFrame([{
+                'Stage': m['stage'],
+                'Labels': ', '.join(f"{k}={v}" for k, v in m['labels'].items()),
+                'Count': m['count'],
+                'Mean (ms)': round(m['mean_ms'], 1),
+                'p50 (ms)': round(m['p50_ms'], 1),
+                'p95 (ms)': round(m['p95_ms'], 1),
+                'p99 (ms)': round(m['p99_ms'], 1),
+                'Max (ms)': round(m['max_ms'], 1)
+            } for m in stage_metrics])
+            st.dataframe(latency_df, use_container_width=True, hide_index=True)
+            if st.button("🧹 Reset Timings"):
+                get_metrics().reset()
+                st.rerun()
+        else:
+            st.info("No timings recorded yet")
     
     with tab4:
         st.subheader("📈 Reports")
@@ -944,6 +1034,12 @@ def main():
             st.error("❌ Unknown role")
     else:
         login_page()
+    
+    clock = _startup_clock()
+    if clock['first_render'] is None:
+        clock['first_render'] = time.perf_counter() - clock['started']
+        print(f"Cold start to first rendered page: {clock['first_render']:.2f}s "
+              f"(face engine: {engine_status()['state']})")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,265 @@
+"""
+Recognition accuracy vs speed on a labelled face dataset
+Reads a local folder with one subfolder of images per person, enrolls the
+first --enroll images of each person (one averaged template, as the app
+stores) and identifies the rest against the gallery. A share of people is
+kept out of the gallery as impostors. Every backend x detection size is
+embedded once; every template dtype x ANN setting is then matched, giving
+open-set ROC/DET points (detection and identification rate vs false
+positive identification rate) over a threshold sweep, rank-1 hit rate,
+and embedding and matching throughput per setting.
+
+Usage:
+    python benchmarks/evaluate_recognition.py <dataset_dir> [--enroll 1] [--impostors 0.2]
+        [--backends insightface,opencv] [--det-sizes auto,640x640] [--dtypes float32,int8]
+        [--nprobe 0,8] [--output report.json] [--plot curves.png]
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, str(ROOT))
+from config import FACE_SIMILARITY_THRESHOLD, FACE_GROUP_SIMILARITY_THRESHOLD
+from ann_index import IVFIndex
+from face_backends import BACKENDS
+from face_gallery import FaceGallery, TEMPLATE_DTYPES
+from face_recognition_module import FaceRecognitionEngine
+
+# Optional: ROC/DET plots
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.bmp'}
+THRESHOLDS = np.round(np.arange(-0.2, 1.0001, 0.01), 2)
+# False positive identification rates to report operating thresholds at
+TARGET_FPIRS = [0.1, 0.01, 0.001]
+SEED = 0
+
+
+def load_dataset(root, enroll, impostor_share, rng):
+    """Split <root>/<person>/<image> into enrollment images, genuine probes and impostor probes"""
+    people = {}
+    for folder in sorted(p for p in Path(root).iterdir() if p.is_dir()):
+        images = sorted(p for p in folder.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+        if images:
+            people[folder.name] = images
+    names = list(people)
+    n_impostors = int(round(len(names) * impostor_share))
+    impostors = set(rng.choice(names, n_impostors, replace=False)) if n_impostors else set()
+
+    enrolled, probes = {}, []
+    for name in names:
+        images = people[name]
+        if name in impostors:
+            probes.extend((None, path) for path in images)
+        elif len(images) > enroll:
+            enrolled[name] = images[:enroll]
+            probes.extend((name, path) for path in images[enroll:])
+    return enrolled, probes
+
+
+def embed_images(engine, paths):
+    """Embedding of the first detected face per image (None where none passes), plus seconds taken"""
+    embeddings = []
+    start = time.perf_counter()
+    for path in paths:
+        _, detections = engine.detect_encoded(path.read_bytes(), max_faces=1)
+        embeddings.append(detections[0]['embedding'] if detections and detections[0]['embedding'] is not None else None)
+    return embeddings, time.perf_counter() - start
+
+
+def build_templates(enrolled, embeddings):
+    """One L2-normalized mean embedding per person with at least one usable image"""
+    templates = {}
+    for name, vectors in enrolled.items():
+        vectors = [embeddings[path] for path in vectors if embeddings[path] is not None]
+        if vectors:
+            templates[name] = FaceGallery.normalize(np.mean(FaceGallery.normalize(vectors), axis=0))[0]
+    return templates
+
+
+def sweep(labels, predicted, scores):
+    """Open-set identification rates at every threshold
+
+    A genuine probe counts as identified when its rank-1 candidate is the
+    right person and scores at or above the threshold (probes without a
+    usable face never are); an impostor probe is a false positive when its
+    rank-1 score reaches the threshold.
+    """
+    genuine = np.array([label is not None for label in labels])
+    correct = np.array([label is not None and label == p for label, p in zip(labels, predicted)])
+    scores = np.asarray(scores, dtype=np.float32)
+    dir_ = [float((correct & (scores >= t)).sum() / max(1, genuine.sum())) for t in THRESHOLDS]
+    fpir = [float(((~genuine) & (scores >= t)).sum() / (~genuine).sum()) if (~genuine).any() else None
+            for t in THRESHOLDS]
+    return dir_, fpir
+
+
+def operating_points(dir_, fpir):
+    """Lowest threshold meeting each target FPIR, with the identification rate there"""
+    points = []
+    for target in TARGET_FPIRS:
+        for t, d, f in zip(THRESHOLDS, dir_, fpir):
+            if f is not None and f <= target:
+                points.append({'fpir': target, 'threshold': float(t), 'dir': round(d, 4), 'actual_fpir': round(f, 4)})
+                break
+    return points
+
+
+def equal_error(dir_, fpir):
+    """Threshold where the miss rate (1 - DIR) and FPIR cross"""
+    gaps = [abs((1 - d) - f) if f is not None else np.inf for d, f in zip(dir_, fpir)]
+    i = int(np.argmin(gaps))
+    if not np.isfinite(gaps[i]):
+        return None
+    return {'threshold': float(THRESHOLDS[i]), 'rate': round(((1 - dir_[i]) + fpir[i]) / 2, 4)}
+
+
+def evaluate_gallery(templates, probe_labels, probe_embeddings, dtype, nprobe):
+    """Identify every probe against one gallery configuration"""
+    gallery = FaceGallery(templates, dtype=dtype)
+    if nprobe and len(gallery):
+        gallery.index = IVFIndex(nprobe=nprobe).build(gallery)
+
+    usable = [i for i, e in enumerate(probe_embeddings) if e is not None]
+    predicted = [None] * len(probe_labels)
+    scores = np.full(len(probe_labels), -1.0, dtype=np.float32)
+    seconds = 0.0
+    if usable and len(gallery):
+        start = time.perf_counter()
+        best_idx, best, _ = gallery.match([probe_embeddings[i] for i in usable])
+        seconds = time.perf_counter() - start
+        for i, row, score in zip(usable, best_idx, best):
+            if row >= 0:
+                predicted[i] = gallery.ids[row]
+                scores[i] = score
+
+    genuine = [i for i, label in enumerate(probe_labels) if label is not None]
+    hits = sum(predicted[i] == probe_labels[i] for i in genuine)
+    dir_, fpir = sweep(probe_labels, predicted, scores)
+    return {
+        'dtype': dtype,
+        'nprobe': nprobe or None,
+        'gallery_bytes': gallery.nbytes,
+        'rank1_hit_rate': round(hits / max(1, len(genuine)), 4),
+        'match_per_s': round(len(usable) / seconds, 1) if seconds else None,
+        'eer': equal_error(dir_, fpir),
+        'operating_points': operating_points(dir_, fpir),
+        'current_thresholds': {
+            str(t): {'dir': round(dir_[j], 4), 'fpir': None if fpir[j] is None else round(fpir[j], 4)}
+            for t in (FACE_SIMILARITY_THRESHOLD, FACE_GROUP_SIMILARITY_THRESHOLD)
+            for j in [int(np.argmin(np.abs(THRESHOLDS - t)))]
+        },
+        'curve': {'threshold': THRESHOLDS.tolist(), 'dir': dir_, 'fpir': fpir}
+    }
+
+
+def evaluate(dataset, backends, det_sizes, dtypes, nprobes, enroll, impostor_share, descriptor='lbp_hog'):
+    rng = np.random.default_rng(SEED)
+    enrolled, probes = load_dataset(dataset, enroll, impostor_share, rng)
+    if not enrolled:
+        raise SystemExit(f"No person in {dataset} has more than {enroll} image(s)")
+    enroll_paths = [path for paths in enrolled.values() for path in paths]
+    probe_labels = [label for label, _ in probes]
+    print(f"{len(enrolled)} enrolled people, {sum(l is not None for l in probe_labels)} genuine and "
+          f"{sum(l is None for l in probe_labels)} impostor probes", file=sys.stderr)
+
+    results = []
+    for backend in backends:
+        for det_size in det_sizes:
+            engine = FaceRecognitionEngine(model=backend, det_size=det_size, descriptor=descriptor)
+            if engine.model != backend:
+                print(f"Skipping {backend} backend (not available)", file=sys.stderr)
+                break
+            enroll_vectors, _ = embed_images(engine, enroll_paths)
+            probe_embeddings, seconds = embed_images(engine, [path for _, path in probes])
+            templates = build_templates(enrolled, dict(zip(enroll_paths, enroll_vectors)))
+            setting = {
+                'backend': backend,
+                'det_size': det_size,
+                'descriptor': descriptor,
+                'failure_to_enroll': round(1 - len(templates) / len(enrolled), 4),
+                'failure_to_acquire': round(sum(e is None for e in probe_embeddings) / max(1, len(probes)), 4),
+                'embed_per_s': round(len(probes) / seconds, 2) if seconds else None
+            }
+            for dtype in dtypes:
+                for nprobe in nprobes:
+                    result = {**setting, **evaluate_gallery(templates, probe_labels, probe_embeddings, dtype, nprobe)}
+                    results.append(result)
+                    eer = result['eer']['rate'] if result['eer'] else float('nan')
+                    print(f"{backend:<12} det {det_size:<10} {dtype:<8} nprobe {nprobe or '-':<4} "
+                          f"rank-1 {result['rank1_hit_rate']:.3f}  EER {eer:.3f}  "
+                          f"{setting['embed_per_s'] or 0:>8.1f} img/s", file=sys.stderr)
+    return results
+
+
+def plot(results, path):
+    """ROC (DIR vs FPIR) and DET (FNIR vs FPIR) curves, one line per setting"""
+    fig, (roc, det) = plt.subplots(1, 2, figsize=(12, 5))
+    for result in results:
+        curve = result['curve']
+        points = [(f, d) for f, d in zip(curve['fpir'], curve['dir']) if f is not None and f > 0]
+        if not points:
+            continue
+        fpir, dir_ = zip(*points)
+        label = f"{result['backend']} {result['det_size']} {result['dtype']}" + \
+            (f" nprobe={result['nprobe']}" if result['nprobe'] else '')
+        roc.plot(fpir, dir_, label=label)
+        det.plot(fpir, [1 - d for d in dir_], label=label)
+    roc.set(xscale='log', xlabel='False positive identification rate', ylabel='Detection and identification rate',
+            title='ROC')
+    det.set(xscale='log', yscale='log', xlabel='False positive identification rate',
+            ylabel='False negative identification rate', title='DET')
+    for ax in (roc, det):
+        ax.grid(True, which='both', alpha=0.3)
+    roc.legend(fontsize='small')
+    fig.tight_layout()
+    fig.savefig(path, dpi=120)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('dataset', help='folder with one subfolder of face images per person')
+    parser.add_argument('--enroll', type=int, default=1, help='images per person used as the template')
+    parser.add_argument('--impostors', type=float, default=0.2, help='share of people kept out of the gallery')
+    parser.add_argument('--backends', default=','.join(name for name, cls in BACKENDS.items() if cls.available()))
+    parser.add_argument('--det-sizes', default='auto', help="comma-separated, 'auto' or WxH caps")
+    parser.add_argument('--dtypes', default=','.join(TEMPLATE_DTYPES), help='template storage types')
+    parser.add_argument('--nprobe', default='0', help='comma-separated IVF nprobe values, 0 = exact search')
+    parser.add_argument('--descriptor', default='lbp_hog', choices=['lbp_hog', 'pixels'],
+                        help='MediaPipe/Haar embedding (InsightFace always uses ArcFace)')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--plot', help='save ROC/DET curves to this image (needs matplotlib)')
+    args = parser.parse_args()
+
+    results = evaluate(args.dataset, args.backends.split(','), args.det_sizes.split(','), args.dtypes.split(','),
+                       [int(n) for n in args.nprobe.split(',')], args.enroll, args.impostors, args.descriptor)
+    report = {'dataset': str(Path(args.dataset).resolve()), 'enroll': args.enroll, 'impostors': args.impostors,
+              'results': results}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    if args.plot:
+        if plt is None:
+            print("matplotlib is not installed, skipping plots", file=sys.stderr)
+        else:
+            plot(results, args.plot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Micro-benchmarks for detection, embedding and gallery matching
+Runs offline on the CPU with synthetic frames and random galleries (fixed
+seeds), and writes p50/p95/p99 latency, throughput and peak RSS per case
+as JSON so runs from different commits can be compared.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--quick] [--output results.json]
+    python benchmarks/run_benchmarks.py --compare baseline.json [--tolerance 0.15]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, str(ROOT))
+from cv2_wrapper import cv2
+from config import FACE_ANN_NPROBE
+from ann_index import IVFIndex
+from face_backends import BACKENDS
+from face_gallery import FaceGallery
+from face_recognition_module import FaceRecognitionEngine, match_face_to_students
+from recognition_service import RecognitionService
+
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+GALLERY_SIZES = [10, 100, 1000, 10000, 100000]
+EMBEDDING_DIM = 512
+FACES_PER_FRAME = 30
+# Frames submitted at once by the recognition service case (kiosks at class start)
+BURST_SIZE = 20
+SEED = 0
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(name, fn, iterations, warmup=2, items=1, **params):
+    """Time fn() and summarize; items is the work done per call (for throughput)"""
+    for _ in range(warmup):
+        fn()
+    times = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000
+    result = {
+        'name': name,
+        'params': params,
+        'iterations': iterations,
+        'p50_ms': round(float(p50), 4),
+        'p95_ms': round(float(p95), 4),
+        'p99_ms': round(float(p99), 4),
+        'mean_ms': round(float(times.mean() * 1000), 4),
+        'throughput_per_s': round(float(items * iterations / times.sum()), 2),
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+    print(f"{name:<24} {json.dumps(params):<48} p50 {result['p50_ms']:>10.3f} ms  "
+          f"p99 {result['p99_ms']:>10.3f} ms  {result['throughput_per_s']:>12.1f}/s", file=sys.stderr)
+    return result
+
+
+def synthetic_frame(width, height, rng):
+    """Noisy background with a few face-like blobs"""
+    frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    frame = cv2.GaussianBlur(frame, (0, 0), 3)
+    for _ in range(4):
+        cx, cy = int(rng.integers(width // 8, 7 * width // 8)), int(rng.integers(height // 8, 7 * height // 8))
+        axes = (max(8, width // 20), max(10, height // 12))
+        cv2.ellipse(frame, (cx, cy), axes, 0, 0, 360, (150, 170, 200), -1)
+        cv2.circle(frame, (cx - axes[0] // 2, cy - axes[1] // 4), max(2, axes[0] // 6), (40, 40, 40), -1)
+        cv2.circle(frame, (cx + axes[0] // 2, cy - axes[1] // 4), max(2, axes[0] // 6), (40, 40, 40), -1)
+    return frame
+
+
+def random_embeddings(n, rng, dim=EMBEDDING_DIM):
+    return rng.standard_normal((n, dim), dtype=np.float32)
+
+
+def insightface_models_present():
+    """InsightFace downloads buffalo_l on first use; benchmarks never touch the network"""
+    return (Path.home() / '.insightface' / 'models' / 'buffalo_l').is_dir()
+
+
+class ReplayEngine:
+    """Returns the same embedded detections for every frame, isolating gallery matching"""
+
+    def __init__(self, embeddings):
+        self.detections = [{
+            'bbox': np.array([10 * i, 10, 10 * i + 40, 50]),
+            'embedding': embedding,
+            'confidence': 0.9,
+            'landmarks': None
+        } for i, embedding in enumerate(embeddings)]
+
+    def detect_faces(self, image, embed=True, min_face_size=None):
+        return self.detections
+
+
+def bench_backends(quick, rng):
+    results = []
+    iterations = 5 if quick else 30
+    for name, cls in BACKENDS.items():
+        if not cls.available() or (name == 'insightface' and not insightface_models_present()):
+            print(f"Skipping {name} backend (not available offline)", file=sys.stderr)
+            continue
+        engine = FaceRecognitionEngine(model=name, quality_gate=False, descriptor='lbp_hog')
+        if engine.model != name:
+            continue
+        for width, height in RESOLUTIONS[:2] if quick else RESOLUTIONS:
+            frame = synthetic_frame(width, height, rng)
+            results.append(measure('detect_faces', lambda: engine.detect_faces(frame, embed=False),
+                                   iterations, backend=name, resolution=f"{width}x{height}"))
+
+        frame = synthetic_frame(640, 480, rng)
+        for n_faces in (1, 8) if quick else (1, 8, 32):
+            detections = [{'bbox': np.array([20 * i % 560, 100, 20 * i % 560 + 80, 200]), 'confidence': 0.9,
+                           'embedding': None, 'landmarks': None} for i in range(n_faces)]
+            if name == 'insightface':
+                # Aligned crops need landmarks; place the canonical ones inside each box
+                for d in detections:
+                    x1, y1 = d['bbox'][:2]
+                    d['landmarks'] = np.array([[30, 40], [50, 40], [40, 55], [32, 68], [48, 68]], np.float32) + [x1, y1]
+            results.append(measure('embed_faces', lambda: engine.embed_faces(frame, detections),
+                                   iterations, items=n_faces, backend=name, faces=n_faces))
+    return results
+
+
+def bench_service(quick, rng):
+    """A burst of frames: serial detect_faces calls vs concurrent RecognitionService requests"""
+    usable = [name for name, cls in BACKENDS.items()
+              if cls.available() and (name != 'insightface' or insightface_models_present())]
+    if not usable:
+        return []
+    engine = FaceRecognitionEngine(model=usable[0], descriptor='lbp_hog')
+    frames = [synthetic_frame(640, 480, rng) for _ in range(BURST_SIZE)]
+    iterations = 3 if quick else 15
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    async def burst():
+        async with RecognitionService(engine, executor=executor) as service:
+            await asyncio.gather(*(service.recognize(frame) for frame in frames))
+
+    results = [
+        measure('serial_detect_faces', lambda: [engine.detect_faces(frame) for frame in frames],
+                iterations, items=BURST_SIZE, backend=engine.model, frames=BURST_SIZE),
+        measure('recognition_service', lambda: asyncio.run(burst()),
+                iterations, items=BURST_SIZE, backend=engine.model, frames=BURST_SIZE)
+    ]
+    executor.shutdown()
+    return results
+
+
+def bench_compare(quick, rng):
+    engine = FaceRecognitionEngine(model='opencv', descriptor='lbp_hog')
+    a, b = random_embeddings(2, rng)
+    return [measure('compare_faces', lambda: engine.compare_faces(a, b), 200 if quick else 2000, dim=EMBEDDING_DIM)]
+
+
+def bench_matching(quick, rng):
+    results = []
+    engine = ReplayEngine(random_embeddings(FACES_PER_FRAME, rng))
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    sizes = GALLERY_SIZES[:4] if quick else GALLERY_SIZES
+    for size in sizes:
+        ids = list(range(size))
+        gallery = FaceGallery.from_matrix(ids, FaceGallery.normalize(random_embeddings(size, rng)))
+        iterations = max(5, min(200, 2_000_000 // size)) if not quick else max(3, min(50, 200_000 // size))
+        results.append(measure('match_face_to_students',
+                               lambda: match_face_to_students(frame, gallery, threshold=0.5, engine=engine),
+                               iterations, items=FACES_PER_FRAME, gallery_size=size, faces=FACES_PER_FRAME))
+        if size >= 10000:
+            gallery.index = IVFIndex(nprobe=FACE_ANN_NPROBE).build(gallery)
+            results.append(measure('match_face_to_students',
+                                   lambda: match_face_to_students(frame, gallery, threshold=0.5, engine=engine),
+                                   iterations, items=FACES_PER_FRAME, gallery_size=size, faces=FACES_PER_FRAME,
+                                   index='ivf'))
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': getattr(cv2, '__version__', None),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def case_key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline_path, tolerance):
+    """Cases whose p50 grew by more than tolerance relative to a baseline run"""
+    baseline = {case_key(r): r for r in json.loads(Path(baseline_path).read_text())['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get(case_key(result))
+        if before and result['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+            regressions.append({
+                'name': result['name'],
+                'params': result['params'],
+                'baseline_p50_ms': before['p50_ms'],
+                'p50_ms': result['p50_ms'],
+                'change': round(result['p50_ms'] / before['p50_ms'] - 1, 3)
+            })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='fewer iterations and sizes, for CI')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed p50 slowdown (default 15%%)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(SEED)
+    results = (bench_backends(args.quick, rng) + bench_service(args.quick, rng) + bench_compare(args.quick, rng)
+               + bench_matching(args.quick, rng))
+    report = {'environment': environment(), 'quick': args.quick, 'results': results}
+    if args.compare:
+        report['regressions'] = compare(results, args.compare, args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    if report.get('regressions'):
+        for r in report['regressions']:
+            print(f"REGRESSION {r['name']} {json.dumps(r['params'])}: "
+                  f"{r['baseline_p50_ms']:.3f} -> {r['p50_ms']:.3f} ms (+{r['change'] * 100:.0f}%)", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
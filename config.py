@@ -26,8 +26,73 @@ DATABASE_BACKUP_PATH = os.getenv('DATABASE_BACKUP_PATH', './data/backups')
 # ==================== FACE RECOGNITION CONFIGURATION ====================
 FACE_DETECTION_MODEL = os.getenv('FACE_DETECTION_MODEL', 'insightface')
 FACE_CONFIDENCE_THRESHOLD = float(os.getenv('FACE_CONFIDENCE_THRESHOLD', '0.5'))
-FACE_SIMILARITY_THRESHOLD = float(os.getenv('FACE_SIMILARITY_THRESHOLD', '0.6'))
+FACE_SIMILARITY_THRESHOLD = float(os.getenv('FACE_SIMILARITY_THRESHOLD', '0.6'))  # 1:1 check-in against own template
+# Group photos match against a whole section; see benchmarks/evaluate_recognition.py for choosing both
+FACE_GROUP_SIMILARITY_THRESHOLD = float(os.getenv('FACE_GROUP_SIMILARITY_THRESHOLD', '0.5'))
+# Leave a face unmatched when its best two students score closer than this (0 disables)
+FACE_MATCH_MIN_MARGIN = float(os.getenv('FACE_MATCH_MIN_MARGIN', '0.0'))
+# InsightFace models to load ('all' loads every buffalo_l model incl. landmarks and gender/age)
+_face_model_modules = os.getenv('FACE_MODEL_MODULES', 'detection,recognition')
+FACE_MODEL_MODULES = None if _face_model_modules == 'all' else [m.strip() for m in _face_model_modules.split(',')]
+
+# Detection resolution: 'auto' picks it per frame from FACE_MIN_FACE_SIZE, or a fixed 'WxH' cap
+FACE_DET_SIZE = os.getenv('FACE_DET_SIZE', 'auto')
+FACE_MIN_FACE_SIZE = int(os.getenv('FACE_MIN_FACE_SIZE', '40'))  # smallest expected face, original pixels
+FACE_GROUP_MIN_FACE_SIZE = int(os.getenv('FACE_GROUP_MIN_FACE_SIZE', '20'))  # same, for classroom group photos
+FACE_DET_MIN_SIZE = int(os.getenv('FACE_DET_MIN_SIZE', '480'))  # never detect below this longest side
+FACE_DET_MAX_SIZE = int(os.getenv('FACE_DET_MAX_SIZE', '1280'))  # never detect above this longest side
+# MediaPipe/Haar embedding: 'lbp_hog' (304-dim descriptor), 'pixels' (legacy 49,152-dim raw crop)
+# or 'auto' (whichever matches the stored gallery, lbp_hog for a new one)
+FACE_FALLBACK_DESCRIPTOR = os.getenv('FACE_FALLBACK_DESCRIPTOR', 'auto')
+# Project lbp_hog templates onto this many PCA components fitted on the enrolled gallery (0 = off);
+# fitted once the gallery holds that many templates, applied from the next engine start
+FACE_DESCRIPTOR_PCA_COMPONENTS = int(os.getenv('FACE_DESCRIPTOR_PCA_COMPONENTS', '0'))
+
+# Quality gate between detection and embedding (FACE_CONFIDENCE_THRESHOLD is the confidence floor)
+FACE_QUALITY_GATE = os.getenv('FACE_QUALITY_GATE', 'True').lower() == 'true'
+FACE_QUALITY_MIN_SIZE = int(os.getenv('FACE_QUALITY_MIN_SIZE', '20'))  # shorter box side, original pixels
+FACE_QUALITY_MIN_SHARPNESS = float(os.getenv('FACE_QUALITY_MIN_SHARPNESS', '15'))  # Laplacian variance at 64px
+FACE_QUALITY_MAX_YAW = float(os.getenv('FACE_QUALITY_MAX_YAW', '50'))  # degrees, needs landmarks
+# Stricter limits for faces saved as enrollment templates
+FACE_ENROLL_MIN_SIZE = int(os.getenv('FACE_ENROLL_MIN_SIZE', '80'))
+FACE_ENROLL_MIN_SHARPNESS = float(os.getenv('FACE_ENROLL_MIN_SHARPNESS', '40'))
+FACE_ENROLL_MAX_YAW = float(os.getenv('FACE_ENROLL_MAX_YAW', '30'))
+
+# ONNX Runtime sessions for the InsightFace backend
+FACE_ONNX_PROVIDERS = [p.strip() for p in os.getenv('FACE_ONNX_PROVIDERS', 'CPUExecutionProvider').split(',')]
+FACE_ONNX_INTRA_OP_THREADS = int(os.getenv('FACE_ONNX_INTRA_OP_THREADS', '0'))  # 0 = ONNX Runtime default (all cores)
+FACE_ONNX_INTER_OP_THREADS = int(os.getenv('FACE_ONNX_INTER_OP_THREADS', '0'))  # 0 = ONNX Runtime default
+FACE_ONNX_GRAPH_OPTIMIZATION = os.getenv('FACE_ONNX_GRAPH_OPTIMIZATION', 'all')  # disabled, basic, extended or all
+FACE_ONNX_CPU_ARENA = os.getenv('FACE_ONNX_CPU_ARENA', 'True').lower() == 'true'
+
+# Inference worker pool: run the engine in separate processes behind get_face_engine()
+FACE_ENGINE_POOL = os.getenv('FACE_ENGINE_POOL', 'False').lower() == 'true'
+FACE_ENGINE_WORKERS = int(os.getenv('FACE_ENGINE_WORKERS', '0'))  # 0 = physical core count
+FACE_ENGINE_QUEUE_SIZE = int(os.getenv('FACE_ENGINE_QUEUE_SIZE', '0'))  # 0 = 2 * workers
+FACE_ENGINE_TIMEOUT = float(os.getenv('FACE_ENGINE_TIMEOUT', '30'))  # seconds per request
+# Async recognition service: merge requests arriving close together into one batch
+FACE_BATCH_MAX_SIZE = int(os.getenv('FACE_BATCH_MAX_SIZE', '32'))
+FACE_BATCH_MAX_WAIT_MS = float(os.getenv('FACE_BATCH_MAX_WAIT_MS', '5'))
+# Shared recognition server (recognition_server.py): 'unix:/path/to.sock' or 'host:port', empty = in-process
+FACE_SERVER_ADDRESS = os.getenv('FACE_SERVER_ADDRESS', '')
+FACE_SERVER_MAX_MESSAGE_MB = int(os.getenv('FACE_SERVER_MAX_MESSAGE_MB', '256'))
+# Detections for uploaded/captured images, reused across Streamlit reruns (0 disables)
+FACE_DETECTION_CACHE_MB = int(os.getenv('FACE_DETECTION_CACHE_MB', '64'))
+# Uploads larger than this many pixels (after any reduced JPEG decode) are refused
+FACE_MAX_IMAGE_PIXELS = int(os.getenv('FACE_MAX_IMAGE_PIXELS', '24000000'))
+# Per-stage latency histograms shown in the admin System tab
+FACE_METRICS_ENABLED = os.getenv('FACE_METRICS_ENABLED', 'True').lower() == 'true'
 FACE_ENCODINGS_DIR = './data/face_encodings'
+FACE_GALLERY_PATH = os.getenv('FACE_GALLERY_PATH', './data/face_encodings/gallery.fgal')
+FACE_TEMPLATE_DTYPE = os.getenv('FACE_TEMPLATE_DTYPE', 'float32')  # float32, float16 or int8
+FACE_GALLERY_POLL_SECONDS = float(os.getenv('FACE_GALLERY_POLL_SECONDS', '1.0'))  # check for other writers' updates
+
+# Approximate nearest-neighbour search for campus-wide 1:N identification
+FACE_ANN_ENABLED = os.getenv('FACE_ANN_ENABLED', 'True').lower() == 'true'
+FACE_ANN_NLIST = int(os.getenv('FACE_ANN_NLIST', '0'))  # 0 = 4 * sqrt(gallery size)
+FACE_ANN_NPROBE = int(os.getenv('FACE_ANN_NPROBE', '8'))  # higher = better recall, slower
+FACE_ANN_MIN_GALLERY_SIZE = int(os.getenv('FACE_ANN_MIN_GALLERY_SIZE', '5000'))  # exact search below this
+FACE_ANN_RERANK_MARGIN = float(os.getenv('FACE_ANN_RERANK_MARGIN', '0.05'))  # wider re-search of matches below this top-2 margin
 FACE_IMAGES_DIR = './data/face_images'
 
 # ==================== AI CONFIGURATION ====================
@@ -214,6 +279,7 @@ def get_paths_summary():
         'logs_dir': str(LOGS_DIR),
         'database': DATABASE_PATH,
         'face_encodings': FACE_ENCODINGS_DIR,
+        'face_gallery': FACE_GALLERY_PATH,
         'face_images': FACE_IMAGES_DIR,
         'backups': DATABASE_BACKUP_PATH,
     }
@@ -32,6 +32,9 @@ except ImportError as e:
                 """Mock cv2 module for headless environments"""
                 IMREAD_COLOR = 1
                 IMREAD_GRAYSCALE = 0
+                IMREAD_REDUCED_COLOR_2 = 17
+                IMREAD_REDUCED_COLOR_4 = 33
+                IMREAD_REDUCED_COLOR_8 = 65
                 COLOR_BGR2RGB = 4
                 COLOR_BGR2GRAY = 6
                 CASCADE_SCALE_IMAGE = 1
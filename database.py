@@ -8,6 +8,7 @@ import os
 # Ensure we import from the local config, not cv2's config
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from config import DATABASE_PATH
+from metrics import timed
 
 DB_PATH = Path(DATABASE_PATH)
 
@@ -204,6 +205,14 @@ def get_student(student_id):
     results = execute_query('SELECT * FROM students WHERE student_id = ?', (student_id,))
     return results[0] if results else None
 
+def get_students_by_ids(ids):
+    """Get students by their primary keys (students.id) in one query"""
+    ids = list(ids)
+    if not ids:
+        return []
+    placeholders = ','.join('?' * len(ids))
+    return execute_query(f'SELECT * FROM students WHERE id IN ({placeholders})', ids)
+
 def get_student_by_user_id(user_id):
     """Get student by user_id"""
     results = execute_query('SELECT * FROM students WHERE user_id = ?', (user_id,))
@@ -219,6 +228,8 @@ def update_student_face(student_id, face_image_path):
         'UPDATE students SET face_image_path = ? WHERE id = ?',
         (face_image_path, student_id)
     )
+    from section_gallery import invalidate_student
+    invalidate_student(student_id)
 
 # Instructor operations
 def create_instructor(user_id, instructor_id, first_name, last_name, email, phone=None, department=None):
@@ -315,6 +326,8 @@ def enroll_student(student_id, section_id):
             'INSERT INTO enrollments (student_id, section_id) VALUES (?, ?)',
             (student_id, section_id)
         )
+        from section_gallery import invalidate_section
+        invalidate_section(section_id)
         return True
     except sqlite3.IntegrityError:
         return False
@@ -328,6 +341,7 @@ def get_enrollments_by_section(section_id):
     return execute_query('SELECT * FROM enrollments WHERE section_id = ?', (section_id,))
 
 # Attendance operations
+@timed('db_write', op='mark_attendance')
 def mark_attendance(student_id, section_id, status='present', confidence=0.0):
     """Mark attendance for a student"""
     from datetime import date
@@ -348,6 +362,61 @@ def mark_attendance(student_id, section_id, status='present', confidence=0.0):
         )
         return True
 
+@timed('db_write', op='mark_attendance_bulk')
+def mark_attendance_bulk(section_id, matches, status='present'):
+    """Mark attendance for many students of a section in one transaction
+    
+    matches is an iterable of (student_id, confidence); a student listed
+    twice keeps the higher confidence. Students not enrolled in the section
+    or already marked with this status today are skipped, keeping their
+    original check-in time. Returns inserted/updated/skipped counts.
+    """
+    from datetime import date
+    today = date.today()
+    now = datetime.now()
+    
+    best = {}
+    skipped = 0
+    for student_id, confidence in matches:
+        if student_id in best:
+            skipped += 1
+            confidence = max(confidence, best[student_id])
+        best[student_id] = confidence
+    
+    conn = get_connection()
+    try:
+        with conn:
+            cursor = conn.cursor()
+            enrolled = {row[0] for row in cursor.execute(
+                'SELECT student_id FROM enrollments WHERE section_id = ?', (section_id,)
+            )}
+            existing = dict(cursor.execute(
+                'SELECT student_id, status FROM attendance WHERE section_id = ? AND attendance_date = ?',
+                (section_id, today)
+            ))
+            inserts = []
+            updates = []
+            for student_id, confidence in best.items():
+                if student_id not in enrolled or existing.get(student_id) == status:
+                    skipped += 1
+                elif student_id in existing:
+                    updates.append((now, status, confidence, student_id, section_id, today))
+                else:
+                    inserts.append((student_id, section_id, today, now, status, confidence))
+            cursor.executemany(
+                '''INSERT INTO attendance (student_id, section_id, attendance_date, check_in_time, status, confidence)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                inserts
+            )
+            cursor.executemany(
+                '''UPDATE attendance SET check_in_time = ?, status = ?, confidence = ?
+                   WHERE student_id = ? AND section_id = ? AND attendance_date = ?''',
+                updates
+            )
+    finally:
+        conn.close()
+    return {'inserted': len(inserts), 'updated': len(updates), 'skipped': skipped}
+
 def get_attendance_by_date(section_id, attendance_date):
     """Get attendance records for a section on a specific date"""
     return execute_query(
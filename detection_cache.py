@@ -0,0 +1,85 @@
+"""
+Detection result cache
+Streamlit reruns the whole script on every widget interaction, so an
+uploaded or captured image already on screen would be decoded and run
+through the detector again. Results are kept in a bounded LRU keyed by a
+hash of the encoded image bytes and evicted by their size in memory.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def content_hash(data):
+    """Fast 128-bit digest of encoded image bytes"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _entry_size(value):
+    """Approximate bytes held by a cached (image, detections) pair"""
+    image, detections = value
+    size = image.nbytes if image is not None else 0
+    for detection in detections:
+        for item in detection.values():
+            if isinstance(item, np.ndarray):
+                size += item.nbytes
+    return size
+
+
+class DetectionCache:
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Cached value for key (marking it most recently used), or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store value, evicting least recently used entries beyond max_bytes"""
+        size = _entry_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Hit/miss counters and memory use"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
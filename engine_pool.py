@@ -0,0 +1,367 @@
+"""
+Process-pool inference workers for the face engine
+Each worker process loads FaceRecognitionEngine once, serves requests
+from its own bounded queue and answers over its own pipe. Frames travel
+through shared memory segments that are reused between requests; only the
+small detection results are pickled.
+"""
+
+import atexit
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import Future
+from multiprocessing import connection, shared_memory
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import (FACE_DETECTION_MODEL, FACE_DET_SIZE, FACE_ENGINE_WORKERS, FACE_ENGINE_QUEUE_SIZE,
+                    FACE_ENGINE_TIMEOUT, FACE_ONNX_INTRA_OP_THREADS, FACE_ONNX_INTER_OP_THREADS,
+                    FACE_DETECTION_CACHE_MB)
+from detection_cache import DetectionCache
+from metrics import span
+from face_backends import FaceBackend
+from face_recognition_module import FaceRecognitionEngine
+
+# Optional: physical core count (os.cpu_count() reports logical CPUs)
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Segments are sized in whole MiB so slightly different frames can share them
+SEGMENT_ROUNDING = 1 << 20
+# Seconds allowed for the workers to load and warm up their models
+STARTUP_TIMEOUT = 600
+# Longest the dispatcher waits before checking whether the pool was closed
+MONITOR_INTERVAL = 1.0
+
+
+def physical_cores():
+    """Physical core count, falling back to the logical CPU count"""
+    if psutil is not None:
+        cores = psutil.cpu_count(logical=False)
+        if cores:
+            return cores
+    return os.cpu_count() or 1
+
+
+def _worker_main(requests, results, engine_kwargs):
+    """Worker loop: load the engine once, then serve requests until a None sentinel
+
+    results is the write end of this worker's own pipe; nothing is shared
+    with other workers, so a worker killed mid-write only breaks its pipe.
+    """
+    try:
+        engine = FaceRecognitionEngine(**engine_kwargs)
+        engine.warm_up()
+    except Exception as e:
+        results.send((None, False, repr(e)))
+        return
+    results.send((None, True, (engine.engine_type, engine.model, engine.detector_min_face)))
+    segments = {}
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, method, frames, args = request
+        try:
+            images = []
+            for name, offset, shape, dtype in frames:
+                segment = segments.get(name)
+                if segment is None:
+                    segment = segments[name] = shared_memory.SharedMemory(name=name)
+                images.append(np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset))
+
+            if method == 'detect_faces':
+                payload = engine.detect_faces(images[0], **args)
+            elif method == 'embed_faces':
+                # Send back every detection so quality-gated ones keep their place
+                engine.embed_faces(images[0], **args)
+                payload = args['detections']
+            else:
+                payload = engine.detect_faces_batch(images, **args)
+            del images
+            results.send((request_id, True, payload))
+        except Exception as e:
+            results.send((request_id, False, repr(e)))
+
+        # Segments freed by the client stay mapped until the worker lets go of them
+        if len(segments) > 16:
+            for name in list(segments)[:-16]:
+                segments.pop(name).close()
+
+    for segment in segments.values():
+        segment.close()
+
+
+class EnginePool(FaceRecognitionEngine):
+    """Drop-in FaceRecognitionEngine that runs inference in worker processes
+
+    Detection and embedding calls are forwarded to the workers; gallery
+    and comparison helpers run in the calling process as before. Unless
+    FACE_ONNX_*_THREADS are set, each worker's sessions get an equal share
+    of the physical cores so the workers do not oversubscribe the host.
+    Requests go to the live worker with the fewest outstanding ones. A
+    worker that dies (e.g. a crash in native inference code) fails the
+    requests sent to it and is replaced along with its queue and pipe.
+    """
+
+    def __init__(self, n_workers=None, queue_size=None, timeout=FACE_ENGINE_TIMEOUT, **engine_kwargs):
+        self.n_workers = n_workers or FACE_ENGINE_WORKERS or physical_cores()
+        self.timeout = timeout
+        self.engine_type = "Starting"
+        self.model = engine_kwargs.get('model', FACE_DETECTION_MODEL)
+        # Used by detect_encoded to size reduced decodes; updated once the workers report in
+        self.detector_min_face = FaceBackend.min_face_size
+        self.det_size = engine_kwargs.get('det_size', FACE_DET_SIZE)
+        self.detection_cache = DetectionCache(FACE_DETECTION_CACHE_MB << 20)
+        engine_kwargs.setdefault('intra_op_threads', FACE_ONNX_INTRA_OP_THREADS or max(1, physical_cores() // self.n_workers))
+        engine_kwargs.setdefault('inter_op_threads', FACE_ONNX_INTER_OP_THREADS or 1)
+        self._ctx = mp.get_context('spawn')
+        total_queue = queue_size or FACE_ENGINE_QUEUE_SIZE or 2 * self.n_workers
+        self._queue_size = max(1, total_queue // self.n_workers)
+        self._ids = itertools.count()
+        self._futures = {}
+        # Request ids sent to each worker and not answered yet
+        self._pending = [set() for _ in range(self.n_workers)]
+        self._free_segments = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._ready = threading.Event()
+        self._started_workers = 0
+        self._startup_error = None
+        self._engine_kwargs = engine_kwargs
+
+        self._workers = []
+        self._queues = []
+        # Read end of each worker's result pipe; None for a slot that is not restarted
+        self._results = []
+        for _ in range(self.n_workers):
+            worker, requests, results = self._spawn()
+            self._workers.append(worker)
+            self._queues.append(requests)
+            self._results.append(results)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+        atexit.register(self.close)
+
+    def _spawn(self):
+        """Start a worker with a fresh request queue and result pipe; returns (process, queue, pipe)"""
+        requests = self._ctx.Queue(maxsize=self._queue_size)
+        reader, writer = self._ctx.Pipe(duplex=False)
+        worker = self._ctx.Process(target=_worker_main, args=(requests, writer, self._engine_kwargs), daemon=True)
+        worker.start()
+        # Only the worker holds the write end now, so its exit shows up as EOF
+        writer.close()
+        return worker, requests, reader
+
+    def _replace(self, slot, worker):
+        """Fail the requests of a dead (or unreadable) worker and start a replacement"""
+        if self._closed:
+            return
+        if worker.is_alive():
+            worker.kill()
+        worker.join()
+        # Workers that cannot load the engine would only fail again
+        replacement = None if self._startup_error else self._spawn()
+        with self._lock:
+            lost, self._pending[slot] = self._pending[slot], set()
+            dead_queue, dead_results = self._queues[slot], self._results[slot]
+            if replacement is None:
+                self._results[slot] = None
+            else:
+                self._workers[slot], self._queues[slot], self._results[slot] = replacement
+        # A killed worker may leave its queue's lock held, so neither is reused
+        dead_queue.cancel_join_thread()
+        dead_results.close()
+        for request_id in lost:
+            self._resolve(request_id, error=RuntimeError(f"Engine worker exited with code {worker.exitcode}"))
+        if replacement is not None:
+            print(f"Engine pool worker exited with code {worker.exitcode}, restarting it")
+
+    # ==================== SHARED MEMORY ====================
+    def _acquire_segment(self, nbytes):
+        with self._lock:
+            for i, segment in enumerate(self._free_segments):
+                if segment.size >= nbytes:
+                    return self._free_segments.pop(i)
+        size = -(-nbytes // SEGMENT_ROUNDING) * SEGMENT_ROUNDING
+        return shared_memory.SharedMemory(create=True, size=size)
+
+    def _release_segment(self, segment):
+        with self._lock:
+            if not self._closed and len(self._free_segments) < 2 * self.n_workers:
+                self._free_segments.append(segment)
+                return
+        segment.close()
+        segment.unlink()
+
+    # ==================== REQUESTS ====================
+    def _dispatch(self):
+        """Resolve pending futures as worker results arrive and replace workers that exit"""
+        while not self._closed:
+            with self._lock:
+                slots = [(slot, worker, results) for slot, (worker, results)
+                         in enumerate(zip(self._workers, self._results)) if results is not None]
+            connection.wait([results for _, _, results in slots] + [worker.sentinel for _, worker, _ in slots],
+                            timeout=MONITOR_INTERVAL)
+            if self._closed:
+                break
+            for slot, worker, results in slots:
+                try:
+                    # Results sent just before a worker exited are still delivered
+                    while results.poll():
+                        self._handle(results.recv())
+                except Exception:
+                    # EOF or a message cut off by the worker's death
+                    self._replace(slot, worker)
+                    continue
+                if not worker.is_alive():
+                    self._replace(slot, worker)
+
+    def _handle(self, message):
+        request_id, ok, payload = message
+        if request_id is None:
+            if ok:
+                engine_type, self.model, self.detector_min_face = payload
+                self.engine_type = f"{engine_type} ({self.n_workers} worker processes)"
+            else:
+                self._startup_error = payload
+            self._started_workers += 1
+            if self._started_workers == self.n_workers or not ok:
+                self._ready.set()
+        elif ok:
+            self._resolve(request_id, result=payload)
+        else:
+            self._resolve(request_id, error=RuntimeError(payload))
+
+    def _resolve(self, request_id, result=None, error=None):
+        """Complete a pending request's future and recycle its shared memory"""
+        with self._lock:
+            future, segment, slot = self._futures.pop(request_id, (None, None, None))
+            if slot is not None:
+                self._pending[slot].discard(request_id)
+        if segment is not None:
+            self._release_segment(segment)
+        if future is None:
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def _submit(self, method, images, args):
+        images = [np.ascontiguousarray(image) for image in images]
+        segment = self._acquire_segment(max(1, sum(image.nbytes for image in images)))
+        frames = []
+        offset = 0
+        for image in images:
+            np.ndarray(image.shape, dtype=image.dtype, buffer=segment.buf, offset=offset)[...] = image
+            frames.append((segment.name, offset, image.shape, image.dtype.str))
+            offset += image.nbytes
+
+        future = Future()
+        request_id = next(self._ids)
+        with self._lock:
+            slot = min(range(self.n_workers),
+                       key=lambda s: (not self._workers[s].is_alive(), len(self._pending[s])))
+            self._futures[request_id] = (future, segment, slot)
+            self._pending[slot].add(request_id)
+            requests = self._queues[slot]
+        # Blocks when the worker's bounded queue is full, pushing back on callers
+        try:
+            requests.put((request_id, method, frames, args), timeout=self.timeout)
+        except queue.Full:
+            self._resolve(request_id, error=TimeoutError("Engine worker queue stayed full"))
+        return future
+
+    def _call(self, method, images, args, default):
+        try:
+            # Round trip including queueing and shared-memory copies (the
+            # workers' own detect/embed spans stay in their processes)
+            with span(method, engine=f"{self.model} pool"):
+                return self._submit(method, images, args).result(timeout=self.timeout)
+        except Exception as e:
+            print(f"Engine pool {method} error: {e}")
+            return default
+
+    def warm_up(self, frame_shape=None):
+        """Wait until every worker has loaded and warmed up its engine"""
+        if not self._ready.wait(timeout=STARTUP_TIMEOUT):
+            raise RuntimeError("Engine pool workers did not start in time")
+        if self._startup_error:
+            raise RuntimeError(f"Engine pool worker failed to start: {self._startup_error}")
+
+    def detect_faces(self, image, embed=True, min_face_size=None):
+        """Detect faces in a worker process"""
+        return self._call('detect_faces', [image], {'embed': embed, 'min_face_size': min_face_size}, [])
+
+    def embed_faces(self, image, detections, scale=1):
+        """Embed chosen detections in a worker process, updating them in place"""
+        if not detections:
+            return []
+        results = self._call('embed_faces', [image], {'detections': detections, 'scale': scale}, [])
+        for detection, result in zip(detections, results):
+            detection['embedding'] = result['embedding']
+            if 'quality' in result:
+                detection['quality'] = result['quality']
+        return [d for d in detections if d['embedding'] is not None] if results else []
+
+    def detect_faces_batch(self, images, embed_batch_size=32, min_face_size=None):
+        """Spread a batch over the workers, one contiguous chunk per worker"""
+        images = list(images)
+        chunk = max(1, -(-len(images) // self.n_workers))
+        args = {'embed_batch_size': embed_batch_size, 'min_face_size': min_face_size}
+        futures = []
+        for start in range(0, len(images), chunk):
+            part = images[start:start + chunk]
+            valid = [i for i, image in enumerate(part) if image is not None and image.size]
+            futures.append((part, valid, self._submit('detect_faces_batch', [part[i] for i in valid], args)))
+
+        results = []
+        for part, valid, future in futures:
+            part_results = [[] for _ in part]
+            try:
+                for i, detections in zip(valid, future.result(timeout=self.timeout)):
+                    part_results[i] = detections
+            except Exception as e:
+                print(f"Engine pool detect_faces_batch error: {e}")
+            results.extend(part_results)
+        return results
+
+    def get_engine_info(self):
+        info = super().get_engine_info()
+        info['workers'] = self.n_workers
+        info['threads_per_worker'] = self._engine_kwargs['intra_op_threads']
+        return info
+
+    def close(self):
+        """Stop the workers and free shared memory"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            free, self._free_segments = self._free_segments, []
+        for worker, requests in zip(self._workers, self._queues):
+            if worker.is_alive():
+                try:
+                    requests.put(None, timeout=1)
+                except queue.Full:
+                    # A hung worker never drains its queue
+                    worker.kill()
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._dispatcher.join(timeout=2 * MONITOR_INTERVAL)
+        for results in self._results:
+            if results is not None:
+                results.close()
+        for segment in free:
+            segment.close()
+            segment.unlink()
@@ -0,0 +1,297 @@
+"""
+Face detection/recognition backends
+Backends register themselves by name with @register_backend and
+FaceRecognitionEngine picks one from config.FACE_DETECTION_MODEL, falling
+back through BACKEND_FALLBACK_ORDER when it is unavailable or fails to load.
+"""
+
+import os
+import sys
+from importlib.util import find_spec
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cv2_wrapper import cv2
+from config import (FACE_MODEL_MODULES, FACE_FALLBACK_DESCRIPTOR, FACE_ONNX_PROVIDERS,
+                    FACE_ONNX_INTRA_OP_THREADS, FACE_ONNX_INTER_OP_THREADS,
+                    FACE_ONNX_GRAPH_OPTIMIZATION, FACE_ONNX_CPU_ARENA)
+from face_descriptors import compute_descriptors
+
+# Heavy ML packages are only imported when their backend is built, so
+# importing this module (and the app) stays fast
+INSIGHTFACE_AVAILABLE = find_spec('insightface') is not None and find_spec('onnxruntime') is not None
+MEDIAPIPE_AVAILABLE = find_spec('mediapipe') is not None
+insightface = ort = face_align = mp = None
+# Length of the legacy raw-pixel fallback embedding (128x128 RGB)
+PIXEL_DIM = 128 * 128 * 3
+# Fallback descriptor when none is passed; 'auto' is resolved from the site gallery by
+# face_recognition_module.site_descriptor_options, not here
+DEFAULT_DESCRIPTOR = 'lbp_hog' if FACE_FALLBACK_DESCRIPTOR == 'auto' else FACE_FALLBACK_DESCRIPTOR
+
+
+def _load_insightface():
+    """Import InsightFace (SCRFD - best for real-time) and ONNX Runtime on first use"""
+    global insightface, ort, face_align
+    import insightface
+    import insightface.app
+    import onnxruntime as ort
+    from insightface.utils import face_align
+
+
+def _load_mediapipe():
+    """Import MediaPipe on first use; returns False where it cannot load (common on Python 3.13+)"""
+    global mp
+    if mp is None and MEDIAPIPE_AVAILABLE:
+        try:
+            import mediapipe as mp
+        except (ImportError, RuntimeError):
+            return False
+    return mp is not None
+
+
+BACKENDS = {}
+BACKEND_FALLBACK_ORDER = ['insightface', 'mediapipe', 'opencv']
+
+
+def register_backend(name):
+    """Class decorator adding a backend to the registry under name"""
+    def decorator(cls):
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def create_backend(name, **options):
+    """Instantiate the named backend, falling back to the next available one"""
+    if name not in BACKENDS:
+        print(f"Unknown face backend '{name}', available: {', '.join(BACKENDS)}")
+    candidates = [name] + [n for n in BACKEND_FALLBACK_ORDER if n != name]
+    for candidate in candidates:
+        cls = BACKENDS.get(candidate)
+        if cls is None or not cls.available():
+            continue
+        try:
+            return cls(**options)
+        except Exception as e:
+            print(f"{cls.label} initialization failed: {e}")
+    raise RuntimeError("No face detection backend could be initialized")
+
+
+def onnx_session_options(intra_op_threads=None, inter_op_threads=None,
+                         graph_optimization=None, cpu_arena=None):
+    """ONNX Runtime SessionOptions from arguments or FACE_ONNX_* settings"""
+    intra = FACE_ONNX_INTRA_OP_THREADS if intra_op_threads is None else intra_op_threads
+    inter = FACE_ONNX_INTER_OP_THREADS if inter_op_threads is None else inter_op_threads
+    level = graph_optimization or FACE_ONNX_GRAPH_OPTIMIZATION
+    arena = FACE_ONNX_CPU_ARENA if cpu_arena is None else cpu_arena
+    if ort is None:
+        _load_insightface()
+
+    options = ort.SessionOptions()
+    if intra:
+        options.intra_op_num_threads = intra
+    if inter:
+        options.inter_op_num_threads = inter
+    options.graph_optimization_level = {
+        'disabled': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }[level]
+    options.enable_cpu_mem_arena = arena
+    return options
+
+
+def simple_embeddings(face_images, descriptor=DEFAULT_DESCRIPTOR, projection=None):
+    """Fallback embeddings for a batch of face crops
+
+    descriptor='lbp_hog' gives 304-dim LBP + HOG descriptors, reduced
+    further by projection (a face_descriptors.DescriptorPCA) when given;
+    'pixels' keeps the legacy flattened 128x128 RGB crop.
+    """
+    if descriptor == 'pixels':
+        stacked = np.stack([cv2.resize(face, (128, 128)) for face in face_images])
+        return list(stacked.reshape(len(face_images), -1).astype(np.float32) / 255.0)
+    descriptors = compute_descriptors(face_images)
+    if projection is not None:
+        descriptors = projection.transform(descriptors)
+    return list(descriptors)
+
+
+class FaceBackend:
+    """Base backend: detect() finds faces, embed() describes chosen crops"""
+
+    name = None
+    label = None
+    # Smallest face (pixels at detection resolution) the detector finds reliably
+    min_face_size = 30
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def __init__(self, descriptor=DEFAULT_DESCRIPTOR, projection=None):
+        """descriptor and projection choose the fallback embedding (see simple_embeddings)"""
+        self.descriptor = descriptor
+        self.projection = projection
+
+    def detect(self, image, det_size, buffers):
+        """Return detections with full-resolution boxes and 'embedding': None"""
+        raise NotImplementedError
+
+    def embed(self, images, detections):
+        """Return one embedding per (image, detection) pair"""
+        crops = []
+        for image, d in zip(images, detections):
+            x1, y1, x2, y2 = d['bbox']
+            crops.append(image[y1:y2, x1:x2])
+        return simple_embeddings(crops, self.descriptor, self.projection)
+
+    def warm_up(self, det_size):
+        """Run detection and embedding once on a blank frame of det_size"""
+        frame = np.zeros((det_size[1], det_size[0], 3), dtype=np.uint8)
+        self.detect(frame, det_size, {})
+        w, h = det_size
+        self.embed([frame], [{'bbox': np.array([w // 4, h // 4, 3 * w // 4, 3 * h // 4]), 'landmarks': None}])
+
+    @staticmethod
+    def _resize(image, det_size, buffers):
+        # A size rounded up to a multiple of 32 would only stretch a smaller frame
+        if det_size[0] >= image.shape[1] and det_size[1] >= image.shape[0]:
+            return image
+        small = cv2.resize(image, det_size, dst=buffers.get('small'), interpolation=cv2.INTER_AREA)
+        buffers['small'] = small
+        return small
+
+    @staticmethod
+    def _to_detections(boxes, shape):
+        """Clip (x1, y1, x2, y2, confidence) boxes to the frame and drop empty ones"""
+        h, w = shape[:2]
+        detections = []
+        for x1, y1, x2, y2, confidence in boxes:
+            x1, y1, x2, y2 = max(0, x1), max(0, y1), min(w, x2), min(h, y2)
+            if x2 > x1 and y2 > y1:
+                detections.append({
+                    'bbox': np.array([x1, y1, x2, y2]),
+                    'embedding': None,
+                    'confidence': confidence,
+                    'landmarks': None
+                })
+        return detections
+
+
+@register_backend('insightface')
+class InsightFaceBackend(FaceBackend):
+    label = "InsightFace (SCRFD)"
+    min_face_size = 16
+
+    @classmethod
+    def available(cls):
+        return INSIGHTFACE_AVAILABLE
+
+    def __init__(self, model_modules=FACE_MODEL_MODULES, providers=None, descriptor=DEFAULT_DESCRIPTOR,
+                 projection=None, **session_options):
+        # ArcFace embeds every face; the fallback descriptor options are accepted and unused
+        super().__init__(descriptor, projection)
+        _load_insightface()
+        providers = providers or FACE_ONNX_PROVIDERS
+        # By default only the detection and recognition models are loaded
+        # (no landmark/gender-age nets)
+        self.detector = insightface.app.FaceAnalysis(
+            name='buffalo_l',
+            allowed_modules=model_modules,
+            providers=providers
+        )
+        # FaceAnalysis does not forward SessionOptions, so re-create each
+        # model's session with the tuned thread/optimization/arena settings
+        options = onnx_session_options(**session_options)
+        for model in self.detector.models.values():
+            model.session = ort.InferenceSession(model.model_file, sess_options=options, providers=providers)
+        self.detector.prepare(ctx_id=-1, det_size=(640, 480))
+
+    def detect(self, image, det_size, buffers):
+        # SCRFD resizes to input_size and maps boxes/landmarks back itself
+        bboxes, kpss = self.detector.det_model.detect(image, input_size=det_size, max_num=0, metric='default')
+        return [{
+            'bbox': bboxes[i, 0:4].astype(int),
+            'embedding': None,
+            'confidence': bboxes[i, 4],
+            'landmarks': kpss[i] if kpss is not None else None
+        } for i in range(bboxes.shape[0])]
+
+    def embed(self, images, detections):
+        recognizer = self.detector.models['recognition']
+        crops = [
+            face_align.norm_crop(image, landmark=d['landmarks'], image_size=recognizer.input_size[0])
+            for image, d in zip(images, detections)
+        ]
+        return list(recognizer.get_feat(crops))
+
+    def warm_up(self, det_size):
+        self.detect(np.zeros((det_size[1], det_size[0], 3), dtype=np.uint8), det_size, {})
+        # Blank frames have no landmarks to align on, so feed the recognizer directly
+        recognizer = self.detector.models['recognition']
+        size = recognizer.input_size[0]
+        recognizer.get_feat([np.zeros((size, size, 3), dtype=np.uint8)])
+
+
+@register_backend('mediapipe')
+class MediaPipeBackend(FaceBackend):
+    label = "MediaPipe"
+    min_face_size = 20
+
+    @classmethod
+    def available(cls):
+        return _load_mediapipe()
+
+    def __init__(self, intra_op_threads=None, descriptor=DEFAULT_DESCRIPTOR, projection=None, **options):
+        super().__init__(descriptor, projection)
+        if intra_op_threads:
+            cv2.setNumThreads(intra_op_threads)
+        self.face_detection = mp.solutions.face_detection.FaceDetection(
+            model_selection=1,
+            min_detection_confidence=0.5
+        )
+
+    def detect(self, image, det_size, buffers):
+        h, w = image.shape[:2]
+        small = self._resize(image, det_size, buffers)
+        rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=buffers.get('rgb'))
+        buffers['rgb'] = rgb
+        results = self.face_detection.process(rgb)
+        boxes = []
+        for detection in results.detections or []:
+            # Relative coordinates map straight onto the full-resolution frame
+            bbox = detection.location_data.relative_bounding_box
+            x_min, y_min = int(bbox.xmin * w), int(bbox.ymin * h)
+            boxes.append((x_min, y_min, x_min + int(bbox.width * w), y_min + int(bbox.height * h),
+                          detection.score[0]))
+        return self._to_detections(boxes, image.shape)
+
+
+@register_backend('opencv')
+class OpenCVBackend(FaceBackend):
+    label = "OpenCV Haar Cascade"
+    min_face_size = 30
+
+    def __init__(self, intra_op_threads=None, descriptor=DEFAULT_DESCRIPTOR, projection=None, **options):
+        super().__init__(descriptor, projection)
+        if intra_op_threads:
+            cv2.setNumThreads(intra_op_threads)
+        cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        self.face_cascade = cv2.CascadeClassifier(cascade_path)
+
+    def detect(self, image, det_size, buffers):
+        h, w = image.shape[:2]
+        small = self._resize(image, det_size, buffers)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=buffers.get('gray'))
+        buffers['gray'] = gray
+        sx, sy = w / small.shape[1], h / small.shape[0]
+        boxes = [
+            (int(x * sx), int(y * sy), int((x + fw) * sx), int((y + fh) * sy), 0.8)
+            for (x, y, fw, fh) in self.face_cascade.detectMultiScale(gray, 1.3, 5)
+        ]
+        return self._to_detections(boxes, image.shape)
@@ -0,0 +1,155 @@
+"""
+Low-dimensional face descriptors for the MediaPipe/Haar fallback engines
+Replaces the flattened 128x128 RGB pixels (49,152 dims) with a grayscale,
+histogram-equalized crop described by a rotation-invariant uniform LBP
+grid histogram plus a coarse HOG: 304 dims in total. With
+FACE_DESCRIPTOR_PCA_COMPONENTS set, descriptors are further projected with
+a PCA basis fitted on the enrolled gallery (gallery_projection).
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cv2_wrapper import cv2
+
+FACE_SIZE = 64
+LBP_GRID = 4
+LBP_BINS = 10  # riu2 codes 0-8 plus one bin for non-uniform patterns
+# HOG: 32px blocks at 32px stride over the 64px face, 2x2 cells of 16px, 9 orientation bins
+HOG_DIM = 2 * 2 * 4 * 9
+DESCRIPTOR_DIM = LBP_GRID * LBP_GRID * LBP_BINS + HOG_DIM
+_hog = None
+
+# Clockwise 8-neighbourhood offsets (dy, dx) around the centre pixel
+_NEIGHBOURS = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
+
+def _get_hog():
+    global _hog
+    if _hog is None:
+        _hog = cv2.HOGDescriptor((FACE_SIZE, FACE_SIZE), (32, 32), (32, 32), (16, 16), 9)
+    return _hog
+
+
+def preprocess(face_image):
+    """Grayscale, resize and equalize a BGR (or gray) face crop"""
+    if face_image.ndim == 3:
+        face_image = cv2.cvtColor(face_image, cv2.COLOR_BGR2GRAY)
+    face_image = cv2.resize(face_image, (FACE_SIZE, FACE_SIZE), interpolation=cv2.INTER_AREA)
+    return cv2.equalizeHist(face_image)
+
+
+def lbp_histograms(faces):
+    """Rotation-invariant uniform LBP histograms on a grid for a (N, H, W) stack"""
+    faces = faces.astype(np.int16)
+    n, h, w = faces.shape
+    centre = faces[:, 1:-1, 1:-1]
+    bits = np.stack([
+        faces[:, 1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx] >= centre for dy, dx in _NEIGHBOURS
+    ], axis=1)
+    transitions = np.count_nonzero(bits != np.roll(bits, 1, axis=1), axis=1)
+    codes = np.where(transitions <= 2, bits.sum(axis=1), LBP_BINS - 1)
+
+    cell = codes.shape[1] // LBP_GRID
+    codes = codes[:, :cell * LBP_GRID, :cell * LBP_GRID]
+    codes = codes.reshape(n, LBP_GRID, cell, LBP_GRID, cell).transpose(0, 1, 3, 2, 4).reshape(n, LBP_GRID * LBP_GRID, -1)
+    # One bincount over all faces and cells: offset every code into its own bin range
+    per_face = LBP_GRID * LBP_GRID * LBP_BINS
+    offsets = np.arange(LBP_GRID * LBP_GRID)[None, :, None] * LBP_BINS + np.arange(n)[:, None, None] * per_face
+    hist = np.bincount((codes + offsets).ravel(), minlength=n * per_face)
+    return hist.reshape(n, per_face).astype(np.float32)
+
+
+def compute_descriptors(face_images):
+    """Descriptors for a list of BGR face crops as a (N, DESCRIPTOR_DIM) array"""
+    faces = np.stack([preprocess(face) for face in face_images])
+    lbp = np.sqrt(lbp_histograms(faces))
+    hog = np.stack([_get_hog().compute(face).ravel() for face in faces])
+    lbp /= np.linalg.norm(lbp, axis=1, keepdims=True) + 1e-8
+    hog /= np.linalg.norm(hog, axis=1, keepdims=True) + 1e-8
+    return np.hstack([lbp, hog]).astype(np.float32)
+
+
+class DescriptorPCA:
+    """PCA projection fitted on enrolled descriptors, applied to gallery and probes alike"""
+
+    def __init__(self, n_components=64):
+        self.n_components = n_components
+        self.mean = None
+        self.components = None
+
+    @staticmethod
+    def _unit_rows(embeddings):
+        # Stored templates are L2-normalized and fresh descriptors are not; centring needs both alike
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        return embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-8)
+
+    def fit(self, matrix):
+        matrix = self._unit_rows(matrix)
+        n_components = min(self.n_components, matrix.shape[0], matrix.shape[1])
+        self.mean = matrix.mean(axis=0)
+        _, _, vt = np.linalg.svd(matrix - self.mean, full_matrices=False)
+        self.components = vt[:n_components].astype(np.float32)
+        return self
+
+    def transform(self, embeddings):
+        return (self._unit_rows(embeddings) - self.mean) @ self.components.T
+
+    def save(self, path):
+        """Write the basis atomically, like the gallery file it belongs to"""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, mean=self.mean, components=self.components)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            pca = cls(data['components'].shape[0])
+            pca.mean = data['mean']
+            pca.components = data['components']
+        return pca
+
+
+def projection_path(gallery_path):
+    """Where the PCA basis of a gallery file is kept"""
+    gallery_path = Path(gallery_path)
+    return gallery_path.with_name(gallery_path.name + '.pca.npz')
+
+
+def gallery_projection(store, n_components):
+    """PCA basis for LBP/HOG templates in store, fitting it on first use; None while it cannot be
+
+    Once the gallery holds at least n_components raw descriptors the basis
+    is fitted on them, saved next to the gallery file, and every stored
+    template is replaced by its projection in the same rewrite, so stored
+    templates and new probes stay comparable. Galleries of other
+    descriptors (raw pixels, InsightFace) get no projection.
+    """
+    path = projection_path(store.path)
+    if store.dim == DESCRIPTOR_DIM:
+        if len(store) < n_components:
+            return None
+        fitted = []
+
+        def project(matrix):
+            # Another process may have projected the gallery since store.dim was read
+            if matrix.shape[1] != DESCRIPTOR_DIM:
+                return matrix
+            fitted.append(DescriptorPCA(n_components).fit(matrix))
+            fitted[0].save(path)
+            return fitted[0].transform(matrix)
+
+        store.transform(project)
+        if fitted:
+            return fitted[0]
+    if not path.exists():
+        return None
+    pca = DescriptorPCA.load(path)
+    return pca if store.dim in (0, pca.components.shape[0]) else None
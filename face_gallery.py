@@ -0,0 +1,221 @@
+"""
+Face gallery for 1:N identification
+Keeps enrolled embeddings as one pre-normalized matrix so a whole photo's
+worth of detections is scored with a single matrix multiply. Rows can be
+stored as float32, float16 or int8 (with a per-row scale); every row keeps
+its precomputed norm so scoring never recomputes it.
+"""
+
+import numpy as np
+
+TEMPLATE_DTYPES = {
+    'float32': np.float32,
+    'float16': np.float16,
+    'int8': np.int8,
+}
+
+# Rows are widened to float32 this many at a time when scoring compact matrices
+SCORE_BLOCK_ROWS = 4096
+# Ambiguous ANN matches are searched again probing this many times more lists
+RERANK_PROBE_FACTOR = 4
+
+
+def quantize(matrix, dtype='float32'):
+    """Quantize L2-normalized float32 rows; returns (data, scales, norms)
+
+    scales are per-row int8 step sizes (1.0 for float types) and norms are
+    the norms of the dequantized rows, so cosine scores stay exact for the
+    stored template.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype == 'int8':
+        scales = np.abs(matrix).max(axis=1) / 127.0 if matrix.size else np.empty(0, dtype=np.float32)
+        scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+        data = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    else:
+        scales = np.ones(matrix.shape[0], dtype=np.float32)
+        data = matrix.astype(TEMPLATE_DTYPES[dtype])
+    norms = np.linalg.norm(data.astype(np.float32) * scales[:, None], axis=1).astype(np.float32)
+    return data, scales, norms
+
+
+class FaceTemplate:
+    """One stored embedding: compact data plus its scale and precomputed norm"""
+
+    __slots__ = ('data', 'scale', 'norm')
+
+    def __init__(self, data, scale=1.0, norm=None):
+        self.data = data
+        self.scale = float(scale)
+        self.norm = float(np.linalg.norm(self.vector())) if norm is None else float(norm)
+
+    @classmethod
+    def from_embedding(cls, embedding, dtype='float32'):
+        data, scales, norms = quantize(FaceGallery.normalize(embedding), dtype)
+        return cls(data[0], scales[0], norms[0])
+
+    def vector(self):
+        """Dequantized float32 embedding"""
+        return self.data.astype(np.float32) * self.scale
+
+
+class FaceGallery:
+    def __init__(self, encodings=None, dtype='float32'):
+        self.ids = []
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.scales = None
+        self.norms = None
+        # Optional approximate index (ann_index.IVFIndex) over the matrix rows
+        self.index = None
+        if encodings:
+            self.build(encodings, dtype)
+
+    @classmethod
+    def from_matrix(cls, ids, matrix, scales=None, norms=None):
+        """Wrap an already L2-normalized (optionally quantized) matrix without copying"""
+        gallery = cls()
+        gallery.ids = list(ids)
+        if len(gallery.ids):
+            gallery.matrix = matrix
+            gallery.scales = scales
+            gallery.norms = norms
+        return gallery
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dim(self):
+        """Embedding dimension of the gallery rows"""
+        return self.matrix.shape[1]
+
+    @property
+    def nbytes(self):
+        """Memory held by the template matrix"""
+        return self.matrix.nbytes
+
+    @staticmethod
+    def normalize(embeddings):
+        """L2-normalize embeddings row-wise as float32"""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / (norms + 1e-8)
+
+    def build(self, encodings, dtype='float32'):
+        """Build the gallery from a {student_id: embedding} mapping"""
+        ids = []
+        rows = []
+        for student_id, embedding in encodings.items():
+            if embedding is None:
+                continue
+            if isinstance(embedding, FaceTemplate):
+                embedding = embedding.vector()
+            embedding = np.asarray(embedding, dtype=np.float32).ravel()
+            if rows and embedding.shape[0] != rows[0].shape[0]:
+                print(f"Skipping encoding for {student_id}: dimension {embedding.shape[0]} "
+                      f"does not match gallery dimension {rows[0].shape[0]}")
+                continue
+            ids.append(student_id)
+            rows.append(embedding)
+
+        self.ids = ids
+        self.scales = self.norms = None
+        if rows:
+            self.matrix = self.normalize(np.stack(rows))
+            if dtype != 'float32':
+                self.matrix, self.scales, self.norms = quantize(self.matrix, dtype)
+        else:
+            self.matrix = np.empty((0, 0), dtype=np.float32)
+        return self
+
+    def _row_factor(self, rows=slice(None)):
+        """Per-row multiplier turning raw dot products into cosine scores"""
+        if self.scales is None and self.norms is None:
+            return None
+        factor = np.ones(len(self.ids), dtype=np.float32)[rows]
+        if self.scales is not None:
+            factor = factor * self.scales[rows]
+        if self.norms is not None:
+            factor = factor / (self.norms[rows] + 1e-8)
+        return factor
+
+    def rows(self, rows):
+        """Dequantized, unit-norm float32 copy of the selected rows"""
+        data = np.asarray(self.matrix[rows], dtype=np.float32)
+        factor = self._row_factor(rows)
+        if factor is not None:
+            data = data * factor[:, None]
+        return data
+
+    def score(self, embeddings):
+        """Cosine similarity of every query embedding against every gallery row"""
+        queries = self.normalize(embeddings)
+        if not self.ids or queries.shape[1] != self.dim:
+            return np.zeros((queries.shape[0], 0), dtype=np.float32)
+        if self.matrix.dtype == np.float32:
+            scores = queries @ self.matrix.T
+        else:
+            # Compact matrices are widened block by block so the float32 copy stays cache-sized
+            scores = np.empty((queries.shape[0], len(self.ids)), dtype=np.float32)
+            for start in range(0, len(self.ids), SCORE_BLOCK_ROWS):
+                block = np.asarray(self.matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+                scores[:, start:start + SCORE_BLOCK_ROWS] = queries @ block.T
+        factor = self._row_factor()
+        if factor is not None:
+            scores *= factor
+        return scores
+
+    def top_k(self, embeddings, k=2, rerank_margin=None, rerank_threshold=None):
+        """Return the k best rows and their scores per query, best first
+
+        Each query's k best are picked with a partial sort of its score row
+        (argpartition) and only those k are ordered. Missing candidates
+        (small gallery, mismatched dimension) are padded with row -1 and
+        score -1.0. With an ANN index, queries that would match (rank-1 score
+        at least rerank_threshold) but whose rank-1/rank-2 margin is below
+        rerank_margin are searched again over RERANK_PROBE_FACTOR times as
+        many lists; unknown faces never pay for the wider search.
+        """
+        if self.index is not None:
+            queries = self.normalize(embeddings)
+            if self.ids and queries.shape[1] == self.dim:
+                rows, scores = self.index.search(self, queries, k=max(k, 2))
+                if rerank_margin:
+                    ambiguous = scores[:, 0] - scores[:, 1] < rerank_margin
+                    if rerank_threshold is not None:
+                        ambiguous &= scores[:, 0] >= rerank_threshold
+                    ambiguous = np.flatnonzero(ambiguous)
+                    if len(ambiguous):
+                        rows[ambiguous], scores[ambiguous] = self.index.search(
+                            self, queries[ambiguous], k=max(k, 2), nprobe=self.index.nprobe * RERANK_PROBE_FACTOR)
+                return rows[:, :k], scores[:, :k]
+        return self._exact_top_k(embeddings, k)
+
+    def _exact_top_k(self, embeddings, k):
+        scores = self.score(embeddings)
+        n_faces, n_students = scores.shape
+        rows = np.full((n_faces, k), -1, dtype=np.int64)
+        top_scores = np.full((n_faces, k), -1.0, dtype=np.float32)
+        if n_students == 0:
+            return rows, top_scores
+
+        top = min(k, n_students)
+        if top < n_students:
+            # Partition on the scores themselves; negating would copy the whole matrix
+            candidates = np.argpartition(scores, n_students - top, axis=1)[:, n_students - top:]
+        else:
+            candidates = np.broadcast_to(np.arange(n_students), (n_faces, n_students))
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1)
+        rows[:, :top] = np.take_along_axis(candidates, order, axis=1)
+        top_scores[:, :top] = np.take_along_axis(candidate_scores, order, axis=1)
+        return rows, top_scores
+
+    def match(self, embeddings):
+        """Return best index, best score and second-best score per query
+
+        Queries whose dimension does not match the gallery get index -1.
+        The second-best score is -1.0 when the gallery has a single row.
+        """
+        rows, scores = self.top_k(embeddings, k=2)
+        return rows[:, 0], scores[:, 0], scores[:, 1]
@@ -0,0 +1,100 @@
+"""
+Face quality scoring between detection and embedding
+Cheap checks on each detection - detector confidence, box size, blur
+(variance of the Laplacian on a small grayscale crop) and, when 5-point
+landmarks are available, a yaw estimate - so faces that will never match
+are not sent to the recognizer or enrolled as templates.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cv2_wrapper import cv2
+from config import (FACE_CONFIDENCE_THRESHOLD, FACE_QUALITY_MIN_SIZE, FACE_QUALITY_MIN_SHARPNESS,
+                    FACE_QUALITY_MAX_YAW, FACE_ENROLL_MIN_SIZE, FACE_ENROLL_MIN_SHARPNESS, FACE_ENROLL_MAX_YAW)
+
+# Crops are resized to this before measuring blur so scores compare across face sizes
+SHARPNESS_SIZE = 64
+
+
+def face_size(bbox):
+    """Shorter side of a face box in pixels"""
+    x1, y1, x2, y2 = bbox
+    return float(min(x2 - x1, y2 - y1))
+
+
+def sharpness(image, bbox):
+    """Variance of the Laplacian over the face crop; low values mean blur"""
+    x1, y1, x2, y2 = (int(v) for v in bbox)
+    crop = image[max(0, y1):y2, max(0, x1):x2]
+    if crop.size == 0:
+        return 0.0
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    crop = cv2.resize(crop, (SHARPNESS_SIZE, SHARPNESS_SIZE), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(crop, cv2.CV_64F).var())
+
+
+def estimate_yaw(landmarks):
+    """Approximate head yaw in degrees from 5-point landmarks, or None
+
+    Uses how far the nose tip sits from the eye midpoint relative to the
+    eye distance (eyes, nose, mouth corners order as in InsightFace kps).
+    """
+    if landmarks is None:
+        return None
+    landmarks = np.asarray(landmarks, dtype=np.float32)
+    if landmarks.shape[0] < 3:
+        return None
+    left_eye, right_eye, nose = landmarks[0], landmarks[1], landmarks[2]
+    eye_distance = np.linalg.norm(right_eye - left_eye)
+    if eye_distance < 1e-6:
+        return 90.0
+    offset = (nose[0] - (left_eye[0] + right_eye[0]) / 2) / eye_distance
+    return float(np.degrees(np.arctan(2 * offset)))
+
+
+def assess_face(image, detection, min_confidence=FACE_CONFIDENCE_THRESHOLD, min_size=FACE_QUALITY_MIN_SIZE,
+                min_sharpness=FACE_QUALITY_MIN_SHARPNESS, max_yaw=FACE_QUALITY_MAX_YAW, scale=1):
+    """Score one detection; cheapest checks run first and failures skip the rest
+
+    scale is how many times smaller image is than the original photo (a
+    reduced decode), so 'size' is reported in original pixels.
+    """
+    quality = {
+        'confidence': float(detection['confidence']),
+        'size': face_size(detection['bbox']) * scale,
+        'sharpness': None,
+        'yaw': None,
+        'issues': []
+    }
+    if quality['confidence'] < min_confidence:
+        quality['issues'].append('low confidence')
+    if quality['size'] < min_size:
+        quality['issues'].append('too small')
+    if not quality['issues']:
+        quality['yaw'] = estimate_yaw(detection.get('landmarks'))
+        if quality['yaw'] is not None and abs(quality['yaw']) > max_yaw:
+            quality['issues'].append('turned away')
+        else:
+            quality['sharpness'] = sharpness(image, detection['bbox'])
+            if quality['sharpness'] < min_sharpness:
+                quality['issues'].append('blurry')
+    quality['passed'] = not quality['issues']
+    return quality
+
+
+def enrollment_issues(quality):
+    """Reasons a face scored by assess_face is not good enough to enroll"""
+    issues = list(quality['issues'])
+    if quality['size'] < FACE_ENROLL_MIN_SIZE and 'too small' not in issues:
+        issues.append('too small')
+    if quality['yaw'] is not None and abs(quality['yaw']) > FACE_ENROLL_MAX_YAW and 'turned away' not in issues:
+        issues.append('turned away')
+    if quality['sharpness'] is not None and quality['sharpness'] < FACE_ENROLL_MIN_SHARPNESS and 'blurry' not in issues:
+        issues.append('blurry')
+    return issues
@@ -2,217 +2,358 @@
 from cv2_wrapper import cv2
 import numpy as np
 from pathlib import Path
-import pickle
 import os
 import sys
+import threading
+import time
 from datetime import datetime
 
 # Ensure we import from the local config, not cv2's config
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from config import FACE_ENCODINGS_DIR
-
-# Try to import InsightFace (SCRFD - best for real-time)
-try:
-    import insightface
-    INSIGHTFACE_AVAILABLE = True
-except ImportError:
-    INSIGHTFACE_AVAILABLE = False
-
-# Fallback to MediaPipe (not available on Python 3.13+)
-try:
-    import mediapipe as mp
-    MEDIAPIPE_AVAILABLE = True
-except (ImportError, RuntimeError):
-    # MediaPipe not available (common on Python 3.13+)
-    MEDIAPIPE_AVAILABLE = False
-    mp = None
+from config import (FACE_ENCODINGS_DIR, FACE_DETECTION_MODEL, FACE_DET_SIZE, FACE_MIN_FACE_SIZE,
+                    FACE_DET_MIN_SIZE, FACE_DET_MAX_SIZE, FACE_ENGINE_POOL, FACE_DETECTION_CACHE_MB,
+                    FACE_QUALITY_GATE, FACE_MATCH_MIN_MARGIN, FACE_ANN_RERANK_MARGIN, FACE_SERVER_ADDRESS,
+                    FACE_FALLBACK_DESCRIPTOR, FACE_DESCRIPTOR_PCA_COMPONENTS)
+from detection_cache import DetectionCache, content_hash
+from image_ingest import decode_image, image_header
+from metrics import span
+from face_backends import BACKENDS, INSIGHTFACE_AVAILABLE, MEDIAPIPE_AVAILABLE, PIXEL_DIM, create_backend
+from face_descriptors import gallery_projection
+from face_gallery import FaceGallery, FaceTemplate
+from face_quality import assess_face, enrollment_issues
+from gallery_store import get_gallery_store
+from ann_index import get_campus_gallery
 
 # Create face encodings directory
 Path(FACE_ENCODINGS_DIR).mkdir(parents=True, exist_ok=True)
 
 class FaceRecognitionEngine:
-    def __init__(self, use_insightface=True):
-        self.use_insightface = use_insightface and INSIGHTFACE_AVAILABLE
-        self.use_mediapipe = MEDIAPIPE_AVAILABLE
+    def __init__(self, model=FACE_DETECTION_MODEL, use_insightface=True, quality_gate=FACE_QUALITY_GATE,
+                 det_size=FACE_DET_SIZE, **backend_options):
+        """Load the backend registered as model (see face_backends)
         
-        if self.use_insightface:
-            try:
-                # Use SCRFD for real-time detection
-                self.detector = insightface.app.FaceAnalysis(
-                    name='buffalo_l',
-                    providers=['CPUProvider']
-                )
-                self.detector.prepare(ctx_id=-1, det_size=(640, 480))
-                self.engine_type = "InsightFace (SCRFD)"
-            except Exception as e:
-                print(f"InsightFace initialization failed: {e}")
-                self.use_insightface = False
-                self._init_mediapipe()
-        elif self.use_mediapipe:
-            self._init_mediapipe()
-        else:
-            self._init_opencv()
+        backend_options go to the backend, e.g. model_modules, providers or
+        intra_op_threads/inter_op_threads/graph_optimization/cpu_arena for
+        the ONNX Runtime sessions, or descriptor/projection for the
+        MediaPipe/Haar embedding (see site_descriptor_options). quality_gate skips embedding faces that
+        fail the checks in face_quality. det_size overrides FACE_DET_SIZE.
+        """
+        if not use_insightface and model == 'insightface':
+            model = 'mediapipe'
+        self.backend = create_backend(model, **backend_options)
+        self.model = self.backend.name
+        self.engine_type = self.backend.label
+        self.detector_min_face = self.backend.min_face_size
+        self.quality_gate = quality_gate
+        self.det_size = det_size
+        self.detection_cache = DetectionCache(FACE_DETECTION_CACHE_MB << 20)
     
-    def _init_mediapipe(self):
-        """Initialize MediaPipe face detection"""
-        if mp is None or not MEDIAPIPE_AVAILABLE:
-            self._init_opencv()
-            return
+    def warm_up(self, frame_shape=(480, 640, 3)):
+        """Run one dummy detection and embedding
         
-        try:
-            self.mp_face_detection = mp.solutions.face_detection
-            self.face_detection = self.mp_face_detection.FaceDetection(
-                model_selection=1,
-                min_detection_confidence=0.5
-            )
-            self.engine_type = "MediaPipe"
-        except Exception as e:
-            print(f"MediaPipe initialization failed: {e}")
-            self._init_opencv()
-    
-    def _init_opencv(self):
-        """Initialize OpenCV Haar Cascade"""
-        cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-        self.face_cascade = cv2.CascadeClassifier(cascade_path)
-        self.engine_type = "OpenCV Haar Cascade"
-    
-    def detect_faces(self, image):
-        """Detect faces in image and return bounding boxes and encodings"""
-        if self.use_insightface:
-            return self._detect_insightface(image)
-        elif self.use_mediapipe:
-            return self._detect_mediapipe(image)
-        else:
-            return self._detect_opencv(image)
+        Moves first-call costs (graph optimization, memory arena growth)
+        off the first real request.
+        """
+        self.backend.warm_up(self.choose_detection_size(frame_shape))
     
-    def _detect_insightface(self, image):
-        """Detect faces using InsightFace"""
+    def detect_faces(self, image, embed=True, min_face_size=None):
+        """Detect faces in image and return bounding boxes and encodings
+        
+        With embed=False only the detector runs and every detection's
+        'embedding' is None; use embed_faces() to fill in the ones needed.
+        min_face_size (pixels in the original image) lets callers expecting
+        small faces, e.g. classroom photos, keep a larger detection size.
+        """
         try:
-            faces = self.detector.get(image)
-            detections = []
-            for face in faces:
-                bbox = face.bbox.astype(int)
-                embedding = face.embedding
-                confidence = face.det_score
-                detections.append({
-                    'bbox': bbox,
-                    'embedding': embedding,
-                    'confidence': confidence,
-                    'landmarks': face.kps if hasattr(face, 'kps') else None
-                })
-            return detections
+            detections = self._detect_boxes(image, min_face_size=min_face_size)
         except Exception as e:
-            print(f"InsightFace detection error: {e}")
+            print(f"{self.engine_type} detection error: {e}")
             return []
+        if embed:
+            return self.embed_faces(image, detections)
+        return detections
     
-    def _detect_mediapipe(self, image):
-        """Detect faces using MediaPipe"""
-        try:
-            h, w, c = image.shape
-            results = self.face_detection.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-            detections = []
-            
-            if results.detections:
-                for detection in results.detections:
-                    bbox = detection.location_data.relative_bounding_box
-                    x_min = int(bbox.xmin * w)
-                    y_min = int(bbox.ymin * h)
-                    width = int(bbox.width * w)
-                    height = int(bbox.height * h)
-                    
-                    # Extract face region for encoding
-                    face_region = image[y_min:y_min+height, x_min:x_min+width]
-                    embedding = self._get_simple_embedding(face_region)
-                    
-                    detections.append({
-                        'bbox': np.array([x_min, y_min, x_min+width, y_min+height]),
-                        'embedding': embedding,
-                        'confidence': detection.score[0],
-                        'landmarks': None
-                    })
-            return detections
-        except Exception as e:
-            print(f"MediaPipe detection error: {e}")
+    def embed_faces(self, image, detections, scale=1):
+        """Compute embeddings for chosen detections of one image
+        
+        Detections failing the quality gate get a 'quality' entry and keep
+        'embedding' None, so callers such as the tracker can retry them on
+        a later frame. scale is the reduction factor of a reduced decode, so
+        the gate's size limits apply in original pixels. Returns the
+        detections that were embedded successfully.
+        """
+        candidates = [d for d in detections if self._passes_quality(image, d, scale)]
+        if not candidates:
             return []
-    
-    def _detect_opencv(self, image):
-        """Detect faces using OpenCV Haar Cascade"""
         try:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
-            detections = []
-            
-            for (x, y, w, h) in faces:
-                face_region = image[y:y+h, x:x+w]
-                embedding = self._get_simple_embedding(face_region)
-                
-                detections.append({
-                    'bbox': np.array([x, y, x+w, y+h]),
-                    'embedding': embedding,
-                    'confidence': 0.8,
-                    'landmarks': None
-                })
-            return detections
+            embeddings = self._embed_detections([image] * len(candidates), candidates)
         except Exception as e:
-            print(f"OpenCV detection error: {e}")
+            print(f"{self.engine_type} embedding error: {e}")
             return []
+        for detection, embedding in zip(candidates, embeddings):
+            detection['embedding'] = embedding
+        return candidates
+    
+    def _passes_quality(self, image, detection, scale=1):
+        """Score a detection (stored as detection['quality']) when the gate is on"""
+        if not self.quality_gate:
+            return True
+        with span('quality', engine=self.model):
+            detection['quality'] = assess_face(image, detection, scale=scale)
+        return detection['quality']['passed']
+    
+    def detect_encoded(self, data, max_faces=None, min_face_size=None):
+        """Decode an encoded image (upload/camera bytes), detect and embed its faces
+        
+        Only the first max_faces detections are embedded (all when None);
+        faces failing the quality gate keep 'embedding' None. Results are
+        cached by a hash of the bytes, so a Streamlit rerun with the same
+        image skips decoding and inference; the returned image is read-only
+        and the detections are shared with the cache.
+        JPEGs larger than the detection size are decoded at reduced scale
+        (see image_ingest), so boxes refer to the returned image while
+        quality sizes are in original pixels.
+        Returns (image, detections), with image None if data does not decode.
+        """
+        data = bytes(data)
+        key = (content_hash(data), max_faces, min_face_size)
+        cached = self.detection_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        header = image_header(data)
+        min_side = max(self.choose_detection_size((header[1], header[0]), min_face_size)) if header else None
+        with span('decode', engine=self.model):
+            image, factor = decode_image(data, min_side)
+        if image is None:
+            return None, []
+        # min_face_size is in original pixels
+        detections = self.detect_faces(image, embed=False, min_face_size=(min_face_size or FACE_MIN_FACE_SIZE) / factor)
+        candidates = detections[:max_faces]
+        embedded = self.embed_faces(image, candidates, scale=factor)
+        if len(embedded) < sum(d.get('quality', {'passed': True})['passed'] for d in candidates):
+            # Embedding errors may be transient, so they are not cached
+            return image, []
+        image.flags.writeable = False
+        self.detection_cache.put(key, (image, detections))
+        return image, detections
+    
+    def count_faces(self, image):
+        """Number of faces in image (detection only, no embeddings)"""
+        return len(self.detect_faces(image, embed=False))
     
-    def _get_simple_embedding(self, face_image):
-        """Generate a simple embedding from face image"""
-        # Resize to standard size
-        face_resized = cv2.resize(face_image, (128, 128))
-        # Normalize
-        face_normalized = face_resized.astype(np.float32) / 255.0
-        # Flatten and return as embedding
-        embedding = face_normalized.flatten()
-        return embedding
+    def has_face(self, image):
+        """Whether image contains at least one face (detection only)"""
+        return self.count_faces(image) > 0
+    
+    def detect_faces_batch(self, images, embed_batch_size=32, min_face_size=None):
+        """Detect faces in several frames and return one detection list per frame
+        
+        Frames are grouped by size so per-size buffers are reused across the
+        group, and embeddings for every face in the batch are extracted in
+        batched recognizer calls instead of one call per face.
+        """
+        results = [[] for _ in images]
+        groups = {}
+        for i, image in enumerate(images):
+            if image is not None and image.size:
+                groups.setdefault(image.shape, []).append(i)
+        
+        pending = []
+        for shape, indices in groups.items():
+            buffers = {}
+            for i in indices:
+                try:
+                    results[i] = self._detect_boxes(images[i], buffers, min_face_size)
+                except Exception as e:
+                    print(f"Batch detection error: {e}")
+                    continue
+                pending.extend((i, d) for d in results[i] if self._passes_quality(images[i], d))
+        
+        for start in range(0, len(pending), embed_batch_size):
+            chunk = pending[start:start + embed_batch_size]
+            try:
+                embeddings = self._embed_detections([images[i] for i, _ in chunk], [d for _, d in chunk])
+            except Exception as e:
+                print(f"Batch embedding error: {e}")
+                continue
+            for (_, detection), embedding in zip(chunk, embeddings):
+                detection['embedding'] = embedding
+        
+        return [[d for d in detections if d['embedding'] is not None] for detections in results]
+    
+    def choose_detection_size(self, image_shape, min_face_size=None):
+        """Pick the (width, height) to run the detector at for an image
+        
+        det_size='auto' (FACE_DET_SIZE) shrinks the frame as far as the
+        smallest face the caller expects allows, given the smallest face the
+        active detector can find; a fixed 'WxH' setting is used as an upper
+        bound. Sizes are multiples of 32, as SCRFD's anchor grid requires;
+        a frame already below the size is rounded up (SCRFD pads it), never
+        upscaled.
+        """
+        h, w = image_shape[:2]
+        if self.det_size != 'auto':
+            max_w, max_h = (int(v) for v in self.det_size.lower().split('x'))
+            scale = min(1.0, max_w / w, max_h / h)
+        else:
+            min_face_size = min_face_size or FACE_MIN_FACE_SIZE
+            scale = min(1.0, self.detector_min_face / min_face_size, FACE_DET_MAX_SIZE / max(w, h))
+            scale = max(scale, min(1.0, FACE_DET_MIN_SIZE / max(w, h)))
+        if scale >= 1.0:
+            return -(-w // 32) * 32, -(-h // 32) * 32
+        # Multiples of 32 suit SCRFD's strides and are harmless for the others
+        return max(32, int(round(w * scale / 32)) * 32), max(32, int(round(h * scale / 32)) * 32)
+    
+    def _detect_boxes(self, image, buffers=None, min_face_size=None):
+        """Locate faces without computing embeddings
+        
+        The detector runs on a downscaled copy of the frame (see
+        choose_detection_size) and boxes are mapped back to full resolution.
+        """
+        buffers = {} if buffers is None else buffers
+        with span('detect', engine=self.model):
+            return self.backend.detect(image, self.choose_detection_size(image.shape, min_face_size), buffers)
+    
+    def _embed_detections(self, images, detections):
+        """Compute embeddings for (image, detection) pairs in one batch"""
+        with span('embed', engine=self.model):
+            return self.backend.embed(images, detections)
     
     def compare_faces(self, embedding1, embedding2, threshold=0.6):
-        """Compare two face embeddings"""
+        """Compare two face embeddings
+        
+        Either side may be a FaceTemplate from the gallery, whose norm is
+        precomputed instead of recalculated on every call.
+        """
         if embedding1 is None or embedding2 is None:
             return 0.0
         
-        # Normalize embeddings
-        emb1 = embedding1 / (np.linalg.norm(embedding1) + 1e-8)
-        emb2 = embedding2 / (np.linalg.norm(embedding2) + 1e-8)
+        vec1, norm1 = _vector_and_norm(embedding1)
+        vec2, norm2 = _vector_and_norm(embedding2)
+        # Templates from another backend or descriptor are not comparable
+        if vec1.shape != vec2.shape:
+            return 0.0
         
         # Calculate cosine similarity
-        similarity = np.dot(emb1, emb2)
+        similarity = np.dot(vec1, vec2) / ((norm1 + 1e-8) * (norm2 + 1e-8))
         return float(similarity)
     
-    def save_face_encoding(self, student_id, embedding):
-        """Save face encoding to file"""
-        encoding_path = Path(FACE_ENCODINGS_DIR) / f"{student_id}_encoding.pkl"
-        with open(encoding_path, 'wb') as f:
-            pickle.dump(embedding, f)
-        return str(encoding_path)
+    def save_face_encoding(self, student_id, embedding, quality=None):
+        """Save face encoding to the site gallery
+        
+        quality is the detection's 'quality' entry; faces below the stricter
+        enrollment limits are not saved and None is returned, as it is when
+        the embedding does not fit the stored gallery.
+        """
+        if quality is not None:
+            issues = enrollment_issues(quality)
+            if issues:
+                print(f"Face for student {student_id} not enrolled: {', '.join(issues)}")
+                return None
+        # The campus index and section galleries follow the store's change notifications
+        store = get_gallery_store()
+        try:
+            store.put(student_id, embedding)
+        except ValueError as e:
+            print(f"Face for student {student_id} not enrolled: {e}")
+            return None
+        return str(store.path)
     
     def load_face_encoding(self, student_id):
-        """Load face encoding from file"""
-        encoding_path = Path(FACE_ENCODINGS_DIR) / f"{student_id}_encoding.pkl"
-        if encoding_path.exists():
-            with open(encoding_path, 'rb') as f:
-                return pickle.load(f)
-        return None
+        """Load a student's stored FaceTemplate from the site gallery"""
+        return get_gallery_store().get_template(student_id)
     
     def get_engine_info(self):
         """Get information about the current engine"""
         return {
             'engine': self.engine_type,
+            'model': self.model,
+            'registered_models': list(BACKENDS),
+            'detection_cache': self.detection_cache.stats(),
             'insightface_available': INSIGHTFACE_AVAILABLE,
             'mediapipe_available': MEDIAPIPE_AVAILABLE
         }
 
+def _vector_and_norm(embedding):
+    if isinstance(embedding, FaceTemplate):
+        return embedding.vector(), embedding.norm
+    embedding = np.asarray(embedding, dtype=np.float32).ravel()
+    return embedding, np.linalg.norm(embedding)
+
 # Global instance
 _face_engine = None
+_engine_lock = threading.Lock()
+_warmup = {'state': 'idle', 'started': None, 'seconds': None, 'error': None}
+_warmup_lock = threading.Lock()
+
+def site_descriptor_options(store=None):
+    """descriptor/projection engine options matching the enrolled gallery
+    
+    FACE_FALLBACK_DESCRIPTOR='auto' keeps raw crops for a gallery enrolled
+    with them, so its templates stay comparable until the students are
+    re-enrolled; FACE_DESCRIPTOR_PCA_COMPONENTS adds the gallery's PCA
+    projection to lbp_hog descriptors.
+    """
+    store = store or get_gallery_store()
+    descriptor = FACE_FALLBACK_DESCRIPTOR
+    if descriptor == 'auto':
+        descriptor = 'pixels' if store.dim == PIXEL_DIM else 'lbp_hog'
+    projection = None
+    if descriptor == 'lbp_hog' and FACE_DESCRIPTOR_PCA_COMPONENTS:
+        projection = gallery_projection(store, FACE_DESCRIPTOR_PCA_COMPONENTS)
+    return {'descriptor': descriptor, 'projection': projection}
 
 def get_face_engine():
-    """Get or create face recognition engine"""
+    """Get or create face recognition engine
+    
+    With FACE_SERVER_ADDRESS set this is a RemoteEngine using a shared
+    recognition_server process; with FACE_ENGINE_POOL enabled an
+    EnginePool that forwards detection to worker processes; otherwise an
+    in-process engine.
+    """
     global _face_engine
-    if _face_engine is None:
-        _face_engine = FaceRecognitionEngine()
+    with _engine_lock:
+        if _face_engine is None:
+            if FACE_SERVER_ADDRESS:
+                from recognition_server import RemoteEngine
+                _face_engine = RemoteEngine()
+            elif FACE_ENGINE_POOL:
+                from engine_pool import EnginePool
+                _face_engine = EnginePool(**site_descriptor_options())
+            else:
+                _face_engine = FaceRecognitionEngine(**site_descriptor_options())
     return _face_engine
 
+def _warm_up_engine():
+    try:
+        get_face_engine().warm_up()
+        _warmup['state'] = 'ready'
+    except Exception as e:
+        print(f"Face engine warm-up failed: {e}")
+        _warmup['error'] = str(e)
+        _warmup['state'] = 'failed'
+    _warmup['seconds'] = time.perf_counter() - _warmup['started']
+    print(f"Face engine warm-up {_warmup['state']} after {_warmup['seconds']:.2f}s")
+
+def start_engine_warmup():
+    """Build and warm up the face engine on a background thread
+    
+    Safe to call on every page run; only the first call starts a thread.
+    """
+    with _warmup_lock:
+        if _warmup['state'] != 'idle':
+            return
+        _warmup['state'] = 'loading'
+        _warmup['started'] = time.perf_counter()
+    threading.Thread(target=_warm_up_engine, name='face-engine-warmup', daemon=True).start()
+
+def engine_status():
+    """Warm-up state ('idle', 'loading', 'ready' or 'failed') with timings"""
+    status = dict(_warmup)
+    status['elapsed'] = time.perf_counter() - status['started'] if status['started'] else 0.0
+    return status
+
 def detect_and_encode_face(image_path):
     """Detect and encode face from image file"""
     engine = get_face_engine()
@@ -220,35 +361,61 @@ def detect_and_encode_face(image_path):
     if image is None:
         return None
     
-    detections = engine.detect_faces(image)
-    if detections:
+    detections = engine.detect_faces(image, embed=False)
+    if detections and engine.embed_faces(image, detections[:1]):
         return detections[0]['embedding']
     return None
 
-def match_face_to_students(image, student_encodings, threshold=0.5):
-    """Match detected face to student encodings"""
-    engine = get_face_engine()
-    detections = engine.detect_faces(image)
+def match_face_to_students(image, student_encodings=None, threshold=0.5, min_face_size=None, engine=None,
+                           k=1, min_margin=FACE_MATCH_MIN_MARGIN):
+    """Match detected faces to student encodings
+
+    image may also be encoded image bytes, whose detections are cached
+    across reruns (see FaceRecognitionEngine.detect_encoded).
+    student_encodings is either a {student_id: embedding} mapping or a
+    prebuilt FaceGallery. Every detection is scored against the whole
+    gallery in one matrix multiply. When omitted, faces are identified
+    against every enrolled student (ANN-backed for large galleries).
+    engine defaults to the shared get_face_engine() instance.
+    
+    Each match lists its k best 'candidates' and the 'margin' between the
+    rank-1 and rank-2 scores; faces whose margin is below min_margin are
+    left unmatched as ambiguous (e.g. look-alikes). ANN results above the
+    threshold with a margin below FACE_ANN_RERANK_MARGIN are searched again
+    over more lists.
+    """
+    engine = engine or get_face_engine()
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        _, detections = engine.detect_encoded(image, min_face_size=min_face_size)
+        detections = [d for d in detections if d['embedding'] is not None]
+    else:
+        detections = engine.detect_faces(image, min_face_size=min_face_size)
     
     if not detections:
         return []
     
+    if student_encodings is None:
+        gallery = get_campus_gallery()
+    elif isinstance(student_encodings, FaceGallery):
+        gallery = student_encodings
+    else:
+        gallery = FaceGallery(student_encodings)
+    
+    with span('match', index='ivf' if gallery.index is not None else 'exact'):
+        rows, scores = gallery.top_k([d['embedding'] for d in detections], k=max(k, 2),
+                                     rerank_margin=FACE_ANN_RERANK_MARGIN, rerank_threshold=threshold)
+    
     matches = []
-    for detection in detections:
-        face_embedding = detection['embedding']
-        best_match = None
-        best_similarity = 0
-        
-        for student_id, student_embedding in student_encodings.items():
-            similarity = engine.compare_faces(face_embedding, student_embedding, threshold)
-            if similarity > best_similarity:
-                best_similarity = similarity
-                best_match = student_id
-        
-        if best_similarity >= threshold:
+    for i, detection in enumerate(detections):
+        margin = float(scores[i, 0] - scores[i, 1])
+        if rows[i, 0] >= 0 and scores[i, 0] >= threshold and margin >= min_margin:
             matches.append({
-                'student_id': best_match,
-                'similarity': best_similarity,
+                'student_id': gallery.ids[rows[i, 0]],
+                'similarity': float(scores[i, 0]),
+                'second_similarity': float(scores[i, 1]),
+                'margin': margin,
+                'candidates': [(gallery.ids[row], float(score)) for row, score in zip(rows[i, :k], scores[i, :k])
+                               if row >= 0],
                 'bbox': detection['bbox'],
                 'confidence': detection['confidence']
             })
@@ -0,0 +1,180 @@
+"""
+Cross-frame face tracker for continuous camera use
+Layers IoU/centroid tracking over FaceRecognitionEngine so full detection
+only runs every N frames and the recognition network only runs for new
+tracks or tracks whose identity is not yet confident.
+"""
+
+import os
+import sys
+from itertools import count
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import FACE_SIMILARITY_THRESHOLD
+from face_gallery import FaceGallery
+
+
+def box_iou(boxes_a, boxes_b):
+    """Pairwise IoU between two (N, 4) and (M, 4) arrays of x1, y1, x2, y2 boxes"""
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-8)
+
+
+class FaceTrack:
+    def __init__(self, track_id, detection, frame_index):
+        self.track_id = track_id
+        self.bbox = np.asarray(detection['bbox'], dtype=np.float32)
+        self.velocity = np.zeros(4, dtype=np.float32)
+        self.confidence = detection['confidence']
+        self.last_detected = frame_index
+        self.last_recognized = None
+        self.missed = 0
+        self.student_id = None
+        self.similarity = 0.0
+
+    def predict(self, frame_index):
+        """Box extrapolated at constant velocity since the last detection"""
+        return self.bbox + self.velocity * (frame_index - self.last_detected)
+
+    def update(self, detection, frame_index):
+        bbox = np.asarray(detection['bbox'], dtype=np.float32)
+        frames = frame_index - self.last_detected
+        if frames > 0:
+            self.velocity = (bbox - self.bbox) / frames
+        self.bbox = bbox
+        self.confidence = detection['confidence']
+        self.last_detected = frame_index
+        self.missed = 0
+
+    def to_dict(self, frame_index):
+        return {
+            'track_id': self.track_id,
+            'bbox': self.predict(frame_index).astype(int),
+            'student_id': self.student_id,
+            'similarity': self.similarity,
+            'confidence': self.confidence,
+            'interpolated': frame_index != self.last_detected
+        }
+
+
+class FaceTracker:
+    def __init__(self, engine, gallery=None, detect_every=5, iou_threshold=0.3,
+                 max_missed=3, threshold=FACE_SIMILARITY_THRESHOLD,
+                 confident_similarity=None, reverify_every=10, min_face_size=None):
+        self.engine = engine
+        self.gallery = gallery if gallery is None or isinstance(gallery, FaceGallery) else FaceGallery(gallery)
+        self.detect_every = max(1, detect_every)
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.threshold = threshold
+        # Identity is re-checked while the match is weaker than this
+        self.confident_similarity = threshold + 0.1 if confident_similarity is None else confident_similarity
+        self.reverify_every = reverify_every
+        self.min_face_size = min_face_size
+        self.tracks = []
+        self.frame_index = -1
+        self._ids = count(1)
+        self.stats = {'frames': 0, 'detections': 0, 'embeddings': 0}
+
+    def reset(self):
+        self.tracks = []
+        self.frame_index = -1
+
+    def update(self, frame):
+        """Advance one frame and return the current tracks as dicts"""
+        self.frame_index += 1
+        self.stats['frames'] += 1
+        if self.frame_index % self.detect_every == 0 or not self.tracks:
+            self._detect(frame)
+        return [track.to_dict(self.frame_index) for track in self.tracks]
+
+    def _detect(self, frame):
+        self.stats['detections'] += 1
+        detections = self.engine.detect_faces(frame, embed=False, min_face_size=self.min_face_size)
+        matched = self._associate(detections)
+
+        alive = []
+        for track in self.tracks:
+            if track.last_detected != self.frame_index:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    continue
+            alive.append(track)
+        for i, detection in enumerate(detections):
+            if i not in matched:
+                matched[i] = FaceTrack(next(self._ids), detection, self.frame_index)
+                alive.append(matched[i])
+        self.tracks = alive
+
+        self._recognize(frame, detections, matched)
+
+    def _associate(self, detections):
+        """Greedy IoU matching with a centroid-distance fallback; returns {detection: track}"""
+        matched = {}
+        if not detections or not self.tracks:
+            return matched
+
+        det_boxes = np.stack([np.asarray(d['bbox'], dtype=np.float32) for d in detections])
+        track_boxes = np.stack([t.predict(self.frame_index) for t in self.tracks])
+        iou = box_iou(det_boxes, track_boxes)
+
+        det_centers = (det_boxes[:, :2] + det_boxes[:, 2:]) / 2
+        track_centers = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+        distance = np.linalg.norm(det_centers[:, None] - track_centers[None], axis=2)
+        track_size = np.linalg.norm(track_boxes[:, 2:] - track_boxes[:, :2], axis=1)
+        close = distance < 0.5 * track_size[None, :]
+        # Centroid matches rank below any IoU match above the threshold
+        score = np.where(iou >= self.iou_threshold, 1.0 + iou, np.where(close, 1.0 - distance / (track_size + 1e-8), 0.0))
+
+        used_tracks = set()
+        for flat in np.argsort(-score, axis=None):
+            d, t = np.unravel_index(flat, score.shape)
+            if score[d, t] <= 0:
+                break
+            if d in matched or t in used_tracks:
+                continue
+            matched[int(d)] = self.tracks[t]
+            used_tracks.add(t)
+            self.tracks[t].update(detections[d], self.frame_index)
+        return matched
+
+    def _needs_recognition(self, track):
+        if self.gallery is None:
+            return False
+        if track.last_recognized is None or track.similarity < self.confident_similarity:
+            return True
+        cycles = (self.frame_index - track.last_recognized) // self.detect_every
+        return cycles >= self.reverify_every
+
+    def _recognize(self, frame, detections, matched):
+        """Embed and identify only the tracks that need it"""
+        pending = [(track, detections[i]) for i, track in matched.items() if self._needs_recognition(track)]
+        if not pending:
+            return
+
+        embedded = self.engine.embed_faces(frame, [d for _, d in pending])
+        self.stats['embeddings'] += len(embedded)
+        # Faces failing the quality gate stay unrecognized and are retried next cycle
+        pending = [(track, d) for track, d in pending if d['embedding'] is not None]
+        if not pending:
+            return
+        best_idx, best, _ = self.gallery.match([d['embedding'] for _, d in pending])
+        for (track, _), idx, similarity in zip(pending, best_idx, best):
+            track.last_recognized = self.frame_index
+            if idx >= 0 and similarity >= self.threshold:
+                track.student_id = self.gallery.ids[idx]
+                track.similarity = float(similarity)
+            else:
+                track.student_id = None
+                track.similarity = 0.0
@@ -0,0 +1,427 @@
+"""
+Single-file embedding gallery store
+One file per site holding a version header, an id index and a contiguous
+template matrix (float32, float16 or int8) followed by per-row scales and
+norms. Readers map the arrays with np.memmap so several processes share
+the same pages read-only; writers rewrite the file and swap it in with an
+atomic rename.
+"""
+
+import json
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import FACE_ENCODINGS_DIR, FACE_GALLERY_PATH, FACE_TEMPLATE_DTYPE, FACE_GALLERY_POLL_SECONDS
+from face_gallery import FaceGallery, FaceTemplate, TEMPLATE_DTYPES, quantize
+
+# Advisory locking between writer processes (not available on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = b'FGAL'
+FORMAT_VERSION = 2
+# magic, format version, generation, count, dim, index length, matrix offset, dtype code
+# (format 1 files have no dtype code and hold unit-norm float32 rows only)
+HEADER = struct.Struct('<4sIQQQQQI')
+HEADER_V1 = struct.Struct('<4sIQQQQQ')
+HEADER_SIZE = 64
+ALIGNMENT = 64
+DTYPE_CODES = ['float32', 'float16', 'int8']
+# Rows compared at a time when diffing two versions of the file
+DIFF_BLOCK_ROWS = 4096
+# Largest per-component difference of unit-norm rows still treated as the same template
+DIFF_TOLERANCE = 1e-3
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _vector_offsets(matrix_offset, matrix_nbytes, count):
+    """File offsets of the per-row scales and norms that follow the matrix"""
+    scales_offset = _align(matrix_offset + matrix_nbytes)
+    return scales_offset, _align(scales_offset + 4 * count)
+
+
+def _normalize_id(student_id):
+    if isinstance(student_id, np.integer):
+        return int(student_id)
+    return student_id
+
+
+class _Snapshot:
+    """One loaded version of the gallery file; replaced as a whole, never modified"""
+
+    __slots__ = ('stat', 'generation', 'ids', 'rows', 'matrix', 'scales', 'norms')
+
+    def __init__(self, stat=None, generation=0, ids=(), matrix=None, scales=None, norms=None):
+        self.stat = stat
+        self.generation = generation
+        self.ids = list(ids)
+        self.rows = {student_id: row for row, student_id in enumerate(self.ids)}
+        self.matrix = np.empty((0, 0), dtype=np.float32) if matrix is None else matrix
+        self.scales = scales
+        self.norms = norms
+
+    def gallery(self):
+        return FaceGallery.from_matrix(self.ids, self.matrix, self.scales, self.norms)
+
+
+def _diff(old, new, written=None):
+    """Students whose template was added, changed or removed between two snapshots
+
+    written is the set of ids this process just wrote; when new directly
+    follows old it is the answer and the rows need not be compared.
+    """
+    removed = [student_id for student_id in old.ids if student_id not in new.rows]
+    if written is not None and new.generation == old.generation + 1:
+        changed = [student_id for student_id in written if student_id in new.rows]
+        common = []
+    else:
+        changed = [student_id for student_id in new.ids if student_id not in old.rows]
+        common = [student_id for student_id in new.ids if student_id in old.rows]
+    old_rows = np.array([old.rows[student_id] for student_id in common], dtype=np.int64)
+    new_rows = np.array([new.rows[student_id] for student_id in common], dtype=np.int64)
+    if common and old.matrix.shape[1] != new.matrix.shape[1]:
+        changed.extend(common)
+    elif common:
+        # Rewrites re-normalize (and re-quantize) every row, so untouched rows may differ in the last bits
+        old_gallery, new_gallery = old.gallery(), new.gallery()
+        for start in range(0, len(common), DIFF_BLOCK_ROWS):
+            o, n = old_rows[start:start + DIFF_BLOCK_ROWS], new_rows[start:start + DIFF_BLOCK_ROWS]
+            differs = np.abs(old_gallery.rows(o) - new_gallery.rows(n)).max(axis=1) > DIFF_TOLERANCE
+            changed.extend(common[start + i] for i in np.flatnonzero(differs))
+    return {
+        'previous_generation': old.generation,
+        'generation': new.generation,
+        'size': len(new.ids),
+        'changed': changed,
+        'removed': removed,
+        # Rows of surviving students shift when an earlier row is removed
+        'rows_moved': bool(np.any(old_rows != new_rows)) or any(old.rows[i] < len(new.ids) for i in removed),
+        'rows': {student_id: new.rows[student_id] for student_id in changed},
+        'gallery': new.gallery()
+    }
+
+
+class GalleryStore:
+    def __init__(self, path=FACE_GALLERY_PATH, dtype=FACE_TEMPLATE_DTYPE, poll_seconds=FACE_GALLERY_POLL_SECONDS):
+        self.path = Path(path)
+        # Template dtype used for writes; existing files are re-quantized on rewrite
+        self.dtype = dtype
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        # Reentrant: listeners may read the store while a refresh notifies them
+        self._refresh_lock = threading.RLock()
+        self._snapshot = _Snapshot()
+        self._checked = None
+        self._listeners = []
+
+    # ==================== READING ====================
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _refresh(self, force=False, written=None):
+        """Re-map the gallery file if it changed since the last read
+
+        Other processes' writes are noticed by polling the file's inode,
+        size and mtime, at most every poll_seconds unless forced. The new
+        version is swapped in as one snapshot, so a reader holding the old
+        one (e.g. a match in progress) keeps a consistent view, and
+        listeners are told which students changed.
+        """
+        now = time.monotonic()
+        if not force and self._checked is not None and now - self._checked < self.poll_seconds:
+            return self._snapshot
+        with self._refresh_lock:
+            self._checked = now
+            stat = self._file_stat()
+            previous = self._snapshot
+            if stat == previous.stat:
+                return previous
+            snapshot = self._load(stat) if stat is not None else _Snapshot()
+            self._snapshot = snapshot
+            if self._listeners:
+                delta = _diff(previous, snapshot, written)
+                if delta['changed'] or delta['removed']:
+                    for listener in list(self._listeners):
+                        try:
+                            listener(delta)
+                        except Exception as e:
+                            print(f"Gallery listener error: {e}")
+            return snapshot
+
+    def _load(self, stat):
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            magic, fmt = header[:4], struct.unpack_from('<I', header, 4)[0]
+            if magic != MAGIC or fmt not in (1, FORMAT_VERSION):
+                raise ValueError(f"{self.path} is not a supported face gallery file")
+            if fmt == 1:
+                _, _, generation, count, dim, index_len, offset = HEADER_V1.unpack_from(header)
+                dtype = 'float32'
+            else:
+                _, _, generation, count, dim, index_len, offset, code = HEADER.unpack_from(header)
+                dtype = DTYPE_CODES[code]
+            ids = json.loads(f.read(index_len).decode('utf-8'))
+            scales = norms = matrix = None
+            if count and dim:
+                matrix = np.memmap(f, dtype=TEMPLATE_DTYPES[dtype], mode='r', offset=offset, shape=(count, dim))
+                if fmt != 1:
+                    scales_offset, norms_offset = _vector_offsets(offset, matrix.nbytes, count)
+                    scales = np.memmap(f, dtype=np.float32, mode='r', offset=scales_offset, shape=(count,))
+                    norms = np.memmap(f, dtype=np.float32, mode='r', offset=norms_offset, shape=(count,))
+        return _Snapshot(stat, generation, ids, matrix, scales, norms)
+
+    def snapshot(self):
+        """Current version of the gallery; stays valid after later writes"""
+        return self._refresh()
+
+    def poll(self):
+        """Pick up writes from other processes (rate-limited by poll_seconds)"""
+        self._refresh()
+
+    def subscribe(self, listener):
+        """Call listener(delta) whenever a new version of the file is loaded
+
+        delta lists the 'changed' (added or updated) and 'removed' student
+        ids, their new 'rows', the 'gallery' of the new version, its
+        'generation' and 'previous_generation', and whether surviving rows
+        moved ('rows_moved').
+        """
+        with self._refresh_lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    @property
+    def generation(self):
+        """Write counter stored in the header, bumped on every update"""
+        return self._refresh().generation
+
+    @property
+    def dim(self):
+        """Embedding dimension of the stored templates, 0 while empty"""
+        return self._refresh().matrix.shape[1]
+
+    def __len__(self):
+        return len(self._refresh().ids)
+
+    def __contains__(self, student_id):
+        return _normalize_id(student_id) in self._refresh().rows
+
+    def ids(self):
+        return list(self._refresh().ids)
+
+    def row(self, student_id):
+        """Row number of a student in the matrix or None"""
+        return self._refresh().rows.get(_normalize_id(student_id))
+
+    def get(self, student_id):
+        """Return the stored (L2-normalized) embedding for a student or None"""
+        snapshot = self._refresh()
+        row = snapshot.rows.get(_normalize_id(student_id))
+        if row is None:
+            return None
+        return snapshot.gallery().rows([row])[0]
+
+    def get_template(self, student_id):
+        """Return the stored FaceTemplate (compact data, scale, norm) or None"""
+        snapshot = self._refresh()
+        row = snapshot.rows.get(_normalize_id(student_id))
+        if row is None:
+            return None
+        scale = 1.0 if snapshot.scales is None else snapshot.scales[row]
+        norm = None if snapshot.norms is None else snapshot.norms[row]
+        return FaceTemplate(np.array(snapshot.matrix[row]), scale, norm)
+
+    def gallery(self, student_ids=None):
+        """Build a FaceGallery over all rows or a subset of students
+
+        The full gallery wraps the memory-mapped matrix without copying.
+        """
+        snapshot = self._refresh()
+        if student_ids is None:
+            return snapshot.gallery()
+        ids = []
+        rows = []
+        for student_id in student_ids:
+            student_id = _normalize_id(student_id)
+            row = snapshot.rows.get(student_id)
+            if row is not None:
+                ids.append(student_id)
+                rows.append(row)
+        return FaceGallery.from_matrix(
+            ids, snapshot.matrix[rows],
+            None if snapshot.scales is None else snapshot.scales[rows],
+            None if snapshot.norms is None else snapshot.norms[rows],
+        )
+
+    # ==================== WRITING ====================
+    def put(self, student_id, embedding):
+        """Insert or replace one student's embedding"""
+        self.put_many({student_id: embedding})
+
+    def put_many(self, encodings):
+        """Insert or replace several embeddings in one atomic rewrite"""
+        encodings = {_normalize_id(k): v for k, v in encodings.items() if v is not None}
+        if not encodings:
+            return
+
+        def update(ids, matrix):
+            rows = {student_id: row for row, student_id in enumerate(ids)}
+            new = FaceGallery.normalize([np.asarray(e, dtype=np.float32).ravel() for e in encodings.values()])
+            if matrix.size and new.shape[1] != matrix.shape[1]:
+                raise ValueError(
+                    f"Embedding dimension {new.shape[1]} does not match gallery dimension "
+                    f"{matrix.shape[1]}; re-enroll all students or remove {self.path}"
+                )
+            if not matrix.size:
+                matrix = np.empty((0, new.shape[1]), dtype=np.float32)
+
+            appended = []
+            for student_id, embedding in zip(encodings, new):
+                row = rows.get(student_id)
+                if row is None:
+                    ids.append(student_id)
+                    appended.append(embedding)
+                else:
+                    matrix[row] = embedding
+            if appended:
+                matrix = np.vstack([matrix, np.stack(appended)])
+            return ids, matrix
+
+        self._rewrite(update, encodings)
+
+    def remove(self, student_id):
+        """Drop a student's embedding"""
+        student_id = _normalize_id(student_id)
+
+        def update(ids, matrix):
+            if student_id not in ids:
+                return ids, matrix
+            row = ids.index(student_id)
+            del ids[row]
+            return ids, np.delete(matrix, row, axis=0)
+
+        self._rewrite(update, [student_id])
+
+    def transform(self, transform):
+        """Replace every template with transform(matrix) in one atomic rewrite
+
+        transform gets the unit-norm float32 rows and may change their
+        dimension (e.g. a PCA projection); its output is re-normalized.
+        """
+        def update(ids, matrix):
+            if not ids:
+                return ids, matrix
+            return ids, FaceGallery.normalize(transform(matrix))
+
+        self._rewrite(update, self.ids())
+
+    def _rewrite(self, update, written):
+        """Apply update(ids, matrix) to the current contents and swap the file in
+
+        written are the student ids the update adds, replaces or removes.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self.path.with_name(self.path.name + '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                snapshot = self._refresh(force=True)
+                current = snapshot.gallery().rows(slice(None)) if snapshot.ids else np.empty((0, 0), dtype=np.float32)
+                ids, matrix = update(list(snapshot.ids), current)
+                self._write(ids, matrix, snapshot.generation + 1)
+                self._refresh(force=True, written=set(written))
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, ids, matrix, generation):
+        """Quantize unit-norm float32 rows to the store dtype and write the file"""
+        index = json.dumps(ids).encode('utf-8')
+        count = len(ids)
+        dim = matrix.shape[1] if count else 0
+        offset = _align(HEADER_SIZE + len(index))
+        data, scales, norms = quantize(matrix.reshape(count, dim), self.dtype)
+        scales_offset, norms_offset = _vector_offsets(offset, data.nbytes, count)
+
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, generation, count, dim, len(index), offset,
+                                DTYPE_CODES.index(self.dtype)).ljust(HEADER_SIZE, b'\0'))
+            f.write(index)
+            f.write(b'\0' * (offset - f.tell()))
+            if count:
+                f.write(np.ascontiguousarray(data).tobytes())
+                f.write(b'\0' * (scales_offset - f.tell()))
+                f.write(scales.tobytes())
+                f.write(b'\0' * (norms_offset - f.tell()))
+                f.write(norms.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def migrate_legacy_encodings(store, encodings_dir=FACE_ENCODINGS_DIR):
+    """Import per-student {student_id}_encoding.pkl files into the store
+
+    A site that switched engines can hold pickles of several dimensions;
+    only the largest same-dimension group is imported and the others are
+    reported, since one gallery holds a single dimension. Returns the
+    number of students imported.
+    """
+    by_dim = {}
+    for pkl_path in Path(encodings_dir).glob('*_encoding.pkl'):
+        key = pkl_path.name[:-len('_encoding.pkl')]
+        student_id = int(key) if key.isdigit() else key
+        try:
+            with open(pkl_path, 'rb') as f:
+                embedding = np.asarray(pickle.load(f), dtype=np.float32).ravel()
+        except Exception as e:
+            print(f"Skipping legacy encoding {pkl_path}: {e}")
+            continue
+        by_dim.setdefault(embedding.shape[0], {})[student_id] = embedding
+    if not by_dim:
+        return 0
+
+    dim = max(by_dim, key=lambda d: len(by_dim[d]))
+    for other, skipped in by_dim.items():
+        if other != dim:
+            print(f"Skipping {len(skipped)} legacy encoding(s) of dimension {other} "
+                  f"(imported dimension {dim}); re-enroll those students")
+    try:
+        store.put_many(by_dim[dim])
+    except Exception as e:
+        print(f"Legacy encoding import failed: {e}")
+        return 0
+    return len(by_dim[dim])
+
+
+# Global instance
+_gallery_store = None
+
+def get_gallery_store():
+    """Get or create the site gallery store, importing legacy pickles once"""
+    global _gallery_store
+    if _gallery_store is None:
+        store = GalleryStore()
+        if not store.path.exists():
+            migrate_legacy_encodings(store)
+        _gallery_store = store
+    return _gallery_store
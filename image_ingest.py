@@ -0,0 +1,96 @@
+"""
+Decoding of uploaded and captured images
+JPEGs are decoded directly at 1/2, 1/4 or 1/8 scale (libjpeg DCT scaling
+through IMREAD_REDUCED_COLOR_*) when the caller needs fewer pixels than
+the photo has, which is faster and smaller than a full decode plus
+resize. Sizes are read from the JPEG/PNG header first, so uploads over
+the pixel budget are refused before anything is decoded.
+"""
+
+import os
+import struct
+import sys
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cv2_wrapper import cv2
+from config import FACE_MAX_IMAGE_PIXELS
+
+REDUCED_MODES = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+# Start-of-frame markers carry the image size (C4, C8 and CC are not frames)
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def image_header(data):
+    """(width, height, is_jpeg) from a JPEG or PNG header, or None for other data"""
+    if data[:8] == _PNG_SIGNATURE and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return width, height, False
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+        elif marker in _JPEG_SOF:
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height, True
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Markers without a length field
+            i += 2
+        else:
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+
+def reduction_factor(width, height, min_side=None, max_pixels=FACE_MAX_IMAGE_PIXELS):
+    """Largest JPEG scale denominator whose longest side still covers min_side
+
+    Smaller denominators are skipped when they exceed max_pixels; returns
+    None if not even a 1/8 decode fits.
+    """
+    fits = [f for f in REDUCED_MODES if -(-width // f) * -(-height // f) <= max_pixels]
+    if not fits:
+        return None
+    long_side = max(width, height)
+    usable = [f for f in fits if min_side and -(-long_side // f) >= min_side]
+    return usable[-1] if usable else fits[0]
+
+
+def decode_image(data, min_side=None, max_pixels=FACE_MAX_IMAGE_PIXELS):
+    """Decode image bytes to BGR at the smallest scale covering min_side
+
+    Returns (image, factor), factor being how many times smaller than the
+    original each side is (always 1 for non-JPEG data). image is None when
+    data does not decode or is over max_pixels.
+    """
+    header = image_header(data)
+    factor = 1
+    if header is not None:
+        width, height, is_jpeg = header
+        if is_jpeg:
+            factor = reduction_factor(width, height, min_side, max_pixels)
+        elif width * height > max_pixels:
+            factor = None
+        if factor is None:
+            print(f"Image of {width}x{height} exceeds the {max_pixels} pixel budget")
+            return None, 1
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_MODES[factor])
+    if image is not None and header is None and image.shape[0] * image.shape[1] > max_pixels:
+        print(f"Image of {image.shape[1]}x{image.shape[0]} exceeds the {max_pixels} pixel budget")
+        return None, 1
+    return image, factor
@@ -0,0 +1,123 @@
+"""
+In-process latency metrics
+Timing spans feed fixed-bucket histograms keyed by stage name and labels
+(e.g. the engine model). Recording is a perf_counter pair, a bisect and a
+locked increment, cheap enough to leave on in production; snapshot()
+summarizes everything for the admin System tab.
+"""
+
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import FACE_METRICS_ENABLED
+
+# Bucket upper bounds in seconds: 0.1 ms to ~50 s in sqrt(2) steps
+BUCKET_BOUNDS = [0.0001 * 2 ** (i / 2) for i in range(39)]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (capped at the max seen)"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(BUCKET_BOUNDS[i], self.max) if i < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+
+class MetricsRegistry:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (stage, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Time the enclosed block into the stage's histogram (also on exceptions)"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """One row per stage and label set, latencies in milliseconds"""
+        with self._lock:
+            items = [(stage, labels, h.count, h.total, h.max, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                     for (stage, labels), h in self._histograms.items()]
+        return [{
+            'stage': stage,
+            'labels': dict(labels),
+            'count': count,
+            'mean_ms': total / count * 1000 if count else 0.0,
+            'p50_ms': p50 * 1000,
+            'p95_ms': p95 * 1000,
+            'p99_ms': p99 * 1000,
+            'max_ms': peak * 1000
+        } for stage, labels, count, total, peak, p50, p95, p99 in sorted(items)]
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+# Global instance
+_registry = MetricsRegistry(FACE_METRICS_ENABLED)
+
+
+def get_metrics():
+    """Process-wide metrics registry"""
+    return _registry
+
+
+def span(stage, **labels):
+    """Timing span on the global registry, e.g. with span('detect', engine='opencv'):"""
+    return _registry.span(stage, **labels)
+
+
+def timed(stage, **labels):
+    """Decorator recording every call of a function as a span"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _registry.span(stage, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
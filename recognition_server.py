@@ -0,0 +1,403 @@
+"""
+Local recognition server shared by several app processes
+One process loads the models and serves detect, embed, identify and
+gallery-update requests over a Unix socket or local TCP port, so Streamlit
+replicas on the same host share a single copy of the model and its warm-up.
+Connections are kept open and carry any number of requests. Each message
+is a fixed header, a small JSON document and a binary payload holding the
+raw bytes of every array (frames, boxes, embeddings), so frames are never
+pickled or base64-encoded.
+
+Usage: python recognition_server.py [unix:/path/to.sock | host:port]
+"""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+import numpy as np
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import (FACE_SERVER_ADDRESS, FACE_SERVER_MAX_MESSAGE_MB, FACE_ENGINE_TIMEOUT, FACE_ENGINE_POOL,
+                    FACE_DET_SIZE, FACE_QUALITY_GATE, FACE_DETECTION_CACHE_MB, FACE_SIMILARITY_THRESHOLD)
+from detection_cache import DetectionCache, content_hash
+from metrics import span
+from face_backends import FaceBackend
+from face_recognition_module import FaceRecognitionEngine, match_face_to_students, site_descriptor_options
+from gallery_store import get_gallery_store
+
+# Message header: operation (requests) or status (responses), JSON length, payload length
+FRAME = struct.Struct('<BIQ')
+OPERATIONS = ['info', 'detect', 'embed', 'detect_batch', 'identify', 'gallery_put']
+STATUS_OK = 0
+STATUS_ERROR = 1
+# Seconds a client waits for the server to come up in warm_up()
+STARTUP_TIMEOUT = 600
+
+
+# ==================== PROTOCOL ====================
+def parse_address(address):
+    """(socket family, address) for 'unix:/path/to.sock' or 'host:port'"""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def _encode(value, chunks, offset):
+    """JSON-able copy of value with arrays and bytes moved into chunks; returns (value, offset)"""
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value)
+        chunks.append(memoryview(data).cast('B'))
+        return {'__array__': [offset, list(data.shape), data.dtype.str]}, offset + data.nbytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        chunks.append(memoryview(value).cast('B'))
+        return {'__bytes__': [offset, len(chunks[-1])]}, offset + len(chunks[-1])
+    if isinstance(value, dict):
+        encoded = {}
+        for key, item in value.items():
+            encoded[key], offset = _encode(item, chunks, offset)
+        return encoded, offset
+    if isinstance(value, (list, tuple)):
+        encoded = []
+        for item in value:
+            item, offset = _encode(item, chunks, offset)
+            encoded.append(item)
+        return encoded, offset
+    if isinstance(value, np.generic):
+        return value.item(), offset
+    return value, offset
+
+
+def _decode(value, payload):
+    """Inverse of _encode; arrays are views on the (writable) payload buffer"""
+    if isinstance(value, dict):
+        if '__array__' in value:
+            offset, shape, dtype = value['__array__']
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape)) if shape else 1
+            return np.frombuffer(payload, dtype, count, offset).reshape(shape)
+        if '__bytes__' in value:
+            offset, length = value['__bytes__']
+            return bytes(payload[offset:offset + length])
+        return {key: _decode(item, payload) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item, payload) for item in value]
+    return value
+
+
+def send_message(sock, code, body):
+    chunks = []
+    body, payload_len = _encode(body, chunks, 0)
+    document = json.dumps(body).encode('utf-8')
+    sock.sendall(FRAME.pack(code, len(document), payload_len) + document)
+    for chunk in chunks:
+        sock.sendall(chunk)
+
+
+def _recv_exact(sock, n):
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if not count:
+            raise ConnectionError("Connection closed mid-message")
+        received += count
+    return buffer
+
+
+def recv_message(sock):
+    """(code, body) of the next message, or None when the peer closed the connection"""
+    header = bytearray()
+    while len(header) < FRAME.size:
+        chunk = sock.recv(FRAME.size - len(header))
+        if not chunk:
+            if header:
+                raise ConnectionError("Connection closed mid-message")
+            return None
+        header += chunk
+    code, document_len, payload_len = FRAME.unpack(header)
+    if document_len + payload_len > FACE_SERVER_MAX_MESSAGE_MB << 20:
+        raise ValueError(f"Message of {document_len + payload_len} bytes exceeds FACE_SERVER_MAX_MESSAGE_MB")
+    document = json.loads(_recv_exact(sock, document_len).decode('utf-8'))
+    return code, _decode(document, _recv_exact(sock, payload_len))
+
+
+# ==================== SERVER ====================
+class _Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        if self.request.family != socket.AF_UNIX:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        """Serve requests on one kept-alive connection until the client hangs up"""
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (ConnectionError, ValueError) as e:
+                print(f"Recognition server connection dropped: {e}")
+                return
+            if message is None:
+                return
+            code, args = message
+            try:
+                result = self.server.dispatch(OPERATIONS[code], args)
+                send_message(self.request, STATUS_OK, result)
+            except (ConnectionError, BrokenPipeError):
+                return
+            except Exception as e:
+                send_message(self.request, STATUS_ERROR, repr(e))
+
+
+class _ReusableTCPServer(socketserver.ThreadingTCPServer):
+    # Restarts may rebind while old connections sit in TIME_WAIT
+    allow_reuse_address = True
+
+
+class RecognitionServer:
+    """Serves one FaceRecognitionEngine (or EnginePool) to many clients
+
+    Connections are handled on separate threads, but an in-process engine
+    runs one request at a time: its models (MediaPipe's graph in
+    particular) do not accept concurrent calls. An EnginePool queues
+    requests to its workers itself and is called concurrently.
+    """
+
+    def __init__(self, address=FACE_SERVER_ADDRESS, engine=None):
+        from engine_pool import EnginePool
+        if engine is None:
+            options = site_descriptor_options()
+            engine = EnginePool(**options) if FACE_ENGINE_POOL else FaceRecognitionEngine(**options)
+        self.engine = engine
+        self._engine_lock = nullcontext() if isinstance(engine, EnginePool) else threading.Lock()
+        self.address = address
+        family, bind_address = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(bind_address):
+                os.unlink(bind_address)
+            server_class = socketserver.ThreadingUnixStreamServer
+        else:
+            server_class = _ReusableTCPServer
+        self._server = server_class(bind_address, _Handler, bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.dispatch = self.dispatch
+
+    def serve_forever(self):
+        self.engine.warm_up()
+        self._server.server_bind()
+        self._server.server_activate()
+        print(f"Recognition server ({self.engine.engine_type}) listening on {self.address}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def shutdown(self):
+        self._server.shutdown()
+
+    def dispatch(self, operation, args):
+        with self._engine_lock:
+            return self._run(operation, args)
+
+    def _run(self, operation, args):
+        engine = self.engine
+        if operation == 'info':
+            info = engine.get_engine_info()
+            info.update(model=engine.model, engine_type=engine.engine_type,
+                        detector_min_face=engine.detector_min_face, det_size=engine.det_size)
+            return info
+        if operation == 'detect':
+            if 'data' in args:
+                _, detections = engine.detect_encoded(args['data'], args.get('max_faces'), args.get('min_face_size'))
+                return detections
+            return engine.detect_faces(args['image'], args.get('embed', True), args.get('min_face_size'))
+        if operation == 'embed':
+            # Send back every detection so quality-gated ones keep their place
+            engine.embed_faces(args['image'], args['detections'], args.get('scale', 1))
+            return args['detections']
+        if operation == 'detect_batch':
+            return engine.detect_faces_batch(args['images'], args.get('embed_batch_size', 32), args.get('min_face_size'))
+        if operation == 'identify':
+            student_ids = args.get('student_ids')
+            gallery = get_gallery_store().gallery(student_ids) if student_ids is not None else None
+            image = args['data'] if 'data' in args else args['image']
+            options = {key: args[key] for key in ('min_face_size', 'k', 'min_margin') if args.get(key) is not None}
+            return match_face_to_students(image, gallery, args.get('threshold', FACE_SIMILARITY_THRESHOLD),
+                                          engine=engine, **options)
+        if operation == 'gallery_put':
+            return engine.save_face_encoding(args['student_id'], args['embedding'], args.get('quality'))
+        raise ValueError(f"Unknown operation {operation}")
+
+
+# ==================== CLIENT ====================
+class RemoteEngine(FaceRecognitionEngine):
+    """Drop-in FaceRecognitionEngine that sends inference to a RecognitionServer
+
+    Encoded uploads are sent as they are and decoded on the server, so a
+    check-in costs one round trip carrying the JPEG rather than raw frames;
+    the results are cached in the calling process by content hash. Each
+    thread keeps its own connection open between requests.
+    """
+
+    def __init__(self, address=FACE_SERVER_ADDRESS, timeout=FACE_ENGINE_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self.model = 'remote'
+        self.engine_type = f"Recognition server ({address})"
+        # Replaced by the server's values once warm_up() reaches it
+        self.detector_min_face = FaceBackend.min_face_size
+        self.det_size = FACE_DET_SIZE
+        self.quality_gate = FACE_QUALITY_GATE
+        self.detection_cache = DetectionCache(FACE_DETECTION_CACHE_MB << 20)
+        self._local = threading.local()
+
+    # ==================== CONNECTION ====================
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            family, address = parse_address(self.address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+            if family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._local.sock = sock
+        return sock
+
+    def _disconnect(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def _request(self, operation, args):
+        """Send one request and return its result; reconnects once if the kept-alive socket went stale"""
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                send_message(sock, OPERATIONS.index(operation), args)
+                message = recv_message(sock)
+                if message is None:
+                    raise ConnectionError("Recognition server closed the connection")
+                break
+            except (ConnectionError, socket.timeout, OSError):
+                self._disconnect()
+                if attempt:
+                    raise
+        status, result = message
+        if status != STATUS_OK:
+            raise RuntimeError(result)
+        return result
+
+    def _call(self, operation, args, default):
+        try:
+            with span(operation, engine=f"{self.model} remote"):
+                return self._request(operation, args)
+        except Exception as e:
+            print(f"Recognition server {operation} error: {e}")
+            return default
+
+    # ==================== ENGINE API ====================
+    def warm_up(self, frame_shape=None):
+        """Wait for the server and adopt its model settings"""
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                info = self._request('info', {})
+                break
+            except (ConnectionError, OSError) as e:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Recognition server at {self.address} not reachable: {e}")
+                time.sleep(1.0)
+        self.model = info['model']
+        self.engine_type = f"{info['engine_type']} via {self.address}"
+        self.detector_min_face = info['detector_min_face']
+        self.det_size = info['det_size']
+
+    def detect_encoded(self, data, max_faces=None, min_face_size=None):
+        """Detect and embed faces of an encoded image on the server
+
+        The decoded image stays on the server, so (None, detections) is
+        returned. Empty results are not cached, as they may come from a
+        transient server error.
+        """
+        data = bytes(data)
+        key = (content_hash(data), max_faces, min_face_size)
+        cached = self.detection_cache.get(key)
+        if cached is not None:
+            return cached
+        detections = self._call('detect', {'data': data, 'max_faces': max_faces, 'min_face_size': min_face_size}, [])
+        if detections:
+            self.detection_cache.put(key, (None, detections))
+        return None, detections
+
+    def detect_faces(self, image, embed=True, min_face_size=None):
+        """Detect faces on the server"""
+        return self._call('detect', {'image': image, 'embed': embed, 'min_face_size': min_face_size}, [])
+
+    def embed_faces(self, image, detections, scale=1):
+        """Embed chosen detections on the server, updating them in place"""
+        if not detections:
+            return []
+        results = self._call('embed', {'image': image, 'detections': detections, 'scale': scale}, [])
+        for detection, result in zip(detections, results):
+            detection['embedding'] = result['embedding']
+            if 'quality' in result:
+                detection['quality'] = result['quality']
+        return [d for d in detections if d['embedding'] is not None] if results else []
+
+    def detect_faces_batch(self, images, embed_batch_size=32, min_face_size=None):
+        """Detect faces in several frames with one server round trip"""
+        images = list(images)
+        valid = [i for i, image in enumerate(images) if image is not None and image.size]
+        results = [[] for _ in images]
+        args = {'images': [images[i] for i in valid], 'embed_batch_size': embed_batch_size,
+                'min_face_size': min_face_size}
+        for i, detections in zip(valid, self._call('detect_batch', args, [[] for _ in valid])):
+            results[i] = detections
+        return results
+
+    def identify(self, image, student_ids=None, threshold=FACE_SIMILARITY_THRESHOLD, min_face_size=None, k=None,
+                 min_margin=None):
+        """Match faces against the server's gallery (all students, or student_ids) in one round trip
+
+        image may be a BGR frame or encoded image bytes; returns what
+        match_face_to_students returns.
+        """
+        args = {'threshold': threshold, 'min_face_size': min_face_size, 'k': k, 'min_margin': min_margin,
+                'student_ids': None if student_ids is None else list(student_ids)}
+        args['data' if isinstance(image, (bytes, bytearray, memoryview)) else 'image'] = image
+        return self._call('identify', args, [])
+
+    def save_face_encoding(self, student_id, embedding, quality=None):
+        """Enroll through the server so every replica's writes go through one process"""
+        return self._call('gallery_put', {'student_id': student_id, 'embedding': np.asarray(embedding),
+                                          'quality': quality}, None)
+
+    def get_engine_info(self):
+        info = self._call('info', {}, {})
+        info.update(engine=self.engine_type, server=self.address, detection_cache=self.detection_cache.stats())
+        return info
+
+    def close(self):
+        self._disconnect()
+
+
+if __name__ == "__main__":
+    address = sys.argv[1] if len(sys.argv) > 1 else FACE_SERVER_ADDRESS
+    if not address:
+        print("Usage: python recognition_server.py [unix:/path/to.sock | host:port] (or set FACE_SERVER_ADDRESS)")
+        sys.exit(1)
+    RecognitionServer(address).serve_forever()
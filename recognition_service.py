@@ -0,0 +1,112 @@
+"""
+Asyncio front-end for the face engine with request micro-batching
+Callers await service.recognize(frame); requests arriving within
+max_wait_ms of the first one are merged (up to max_batch_size) into one
+detect_faces_batch call on an executor thread, so a burst of kiosks
+shares batched embedding calls (and, with the engine pool, all worker
+processes) instead of queuing for one detect_faces call each.
+
+    async with RecognitionService() as service:
+        detections = await service.recognize(frame)
+"""
+
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import FACE_BATCH_MAX_SIZE, FACE_BATCH_MAX_WAIT_MS
+from metrics import span
+from face_recognition_module import get_face_engine
+
+
+class RecognitionService:
+    def __init__(self, engine=None, max_batch_size=FACE_BATCH_MAX_SIZE, max_wait_ms=FACE_BATCH_MAX_WAIT_MS,
+                 executor=None):
+        """engine defaults to get_face_engine(); batches run on executor
+        (a single thread unless one is given, e.g. to overlap batches on
+        an EnginePool)"""
+        self.engine = engine or get_face_engine()
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='face-batch')
+        self._queue = None
+        self._worker = None
+        self.stats = {'requests': 0, 'batches': 0, 'largest_batch': 0}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def recognize(self, frame, min_face_size=None):
+        """Detections with embeddings for one BGR frame, as detect_faces returns them"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((frame, min_face_size, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self._queue.get_nowait())
+            await self._process([request for request in batch if not request[2].cancelled()])
+
+    async def _process(self, batch):
+        if not batch:
+            return
+        self.stats['requests'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], len(batch))
+
+        # detect_faces_batch takes one min_face_size, so mixed requests split into groups
+        groups = {}
+        for request in batch:
+            groups.setdefault(request[1], []).append(request)
+        loop = asyncio.get_running_loop()
+        for min_face_size, requests in groups.items():
+            frames = [frame for frame, _, _ in requests]
+            try:
+                with span('batch', engine=self.engine.model):
+                    results = await loop.run_in_executor(
+                        self._executor, lambda: self.engine.detect_faces_batch(frames, min_face_size=min_face_size))
+            except Exception as e:
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), detections in zip(requests, results):
+                if not future.done():
+                    future.set_result(detections)
+
+    async def close(self):
+        """Stop batching; requests still queued are cancelled"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+            while not self._queue.empty():
+                self._queue.get_nowait()[2].cancel()
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,116 @@
+"""
+Per-section compiled galleries
+Compiles a section's enrolled-student gallery and student records once and
+keeps them until an enrollment, face registration or face image update
+touches that section, so reruns of the instructor face tab are a lookup.
+Face registrations are seen through the gallery store, including ones
+made by other processes.
+"""
+
+import os
+import sys
+import threading
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import database as db
+from gallery_store import get_gallery_store
+
+
+class SectionGallery:
+    """A section's FaceGallery plus the student rows behind it"""
+
+    def __init__(self, section_id, enrolled, gallery, students):
+        self.section_id = section_id
+        # students.id of everyone enrolled, with or without a registered face
+        self.enrolled = enrolled
+        self.gallery = gallery
+        # {students.id: students row} for the gallery rows
+        self.students = students
+
+
+class SectionGalleryCache:
+    def __init__(self, store=None):
+        self.store = store
+        self._entries = {}
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a compile racing with one is not cached
+        self._version = 0
+
+    def get(self, section_id):
+        """Compiled gallery for section_id, built on first use"""
+        # Registrations from other processes reach apply_delta through this poll
+        self._store().poll()
+        with self._lock:
+            entry = self._entries.get(section_id)
+            version = self._version
+        if entry is not None:
+            return entry
+
+        entry = self._compile(section_id)
+        with self._lock:
+            if self._version == version:
+                self._entries[section_id] = entry
+        return entry
+
+    def _store(self):
+        return self.store or get_gallery_store()
+
+    def _compile(self, section_id):
+        enrolled = {e[1] for e in db.get_enrollments_by_section(section_id)}
+        gallery = self._store().gallery(sorted(enrolled))
+        students = {s[0]: s for s in db.get_students_by_ids(gallery.ids)}
+        return SectionGallery(section_id, enrolled, gallery, students)
+
+    def invalidate_section(self, section_id):
+        with self._lock:
+            self._version += 1
+            self._entries.pop(section_id, None)
+
+    def invalidate_student(self, student_id):
+        """Drop every cached section the student is enrolled in"""
+        with self._lock:
+            self._version += 1
+            for section_id, entry in list(self._entries.items()):
+                if student_id in entry.enrolled:
+                    del self._entries[section_id]
+
+    def apply_delta(self, delta):
+        """Gallery store listener: drop sections with a student whose template changed"""
+        touched = set(delta['changed']) | set(delta['removed'])
+        with self._lock:
+            self._version += 1
+            for section_id, entry in list(self._entries.items()):
+                if not touched.isdisjoint(entry.enrolled):
+                    del self._entries[section_id]
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+
+# Global instance
+_section_cache = None
+
+
+def get_section_cache():
+    """Get or create the section gallery cache"""
+    global _section_cache
+    if _section_cache is None:
+        _section_cache = SectionGalleryCache()
+        get_gallery_store().subscribe(_section_cache.apply_delta)
+    return _section_cache
+
+
+def get_section_gallery(section_id):
+    """Compiled SectionGallery for a section"""
+    return get_section_cache().get(section_id)
+
+
+def invalidate_section(section_id):
+    get_section_cache().invalidate_section(section_id)
+
+
+def invalidate_student(student_id):
+    get_section_cache().invalidate_student(student_id)
@@ -0,0 +1,211 @@
+"""
+Streaming video ingestion for live classroom cameras
+A grabber thread reads frames from cv2.VideoCapture (device index, video
+file or stream URL) into a small queue that drops the oldest frame when
+full, so recognition always works on recent frames. Frames go through
+FaceTracker against the section gallery and each student identified
+steadily enough is reported once as an attendance event.
+
+Usage: python video_pipeline.py <source> <section_id> [--dry-run]
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+# Ensure we import from the local config, not cv2's config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cv2_wrapper import cv2
+from config import FACE_GROUP_SIMILARITY_THRESHOLD
+import database as db
+from face_recognition_module import get_face_engine
+from face_tracker import FaceTracker
+from section_gallery import get_section_gallery
+
+
+class FrameGrabber:
+    """Background reader keeping only the newest queue_size frames"""
+
+    def __init__(self, source, queue_size=4, reconnect_delay=2.0):
+        # '0' selects a local device; anything else is a file path or URL
+        self.source = int(source) if str(source).isdigit() else source
+        self.reconnect_delay = reconnect_delay
+        self.frames = deque(maxlen=max(1, queue_size))
+        self.grabbed = 0
+        self.dropped = 0
+        self.finished = False
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"frame-grabber-{source}", daemon=True)
+
+    @property
+    def is_live(self):
+        """Devices and stream URLs reconnect; files end when exhausted"""
+        return not isinstance(self.source, str) or '://' in self.source
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def _open(self):
+        capture = cv2.VideoCapture(self.source)
+        if capture.isOpened():
+            return capture
+        capture.release()
+        print(f"Could not open video source {self.source}")
+        return None
+
+    def _run(self):
+        capture = None
+        # Files are paced at their own frame rate, standing in for a live camera
+        interval = 0.0
+        next_frame = time.monotonic()
+        while not self._stop.is_set():
+            if capture is None:
+                capture = self._open()
+                if capture is None:
+                    if not self.is_live:
+                        break
+                    self._stop.wait(self.reconnect_delay)
+                    continue
+                if not self.is_live:
+                    fps = capture.get(cv2.CAP_PROP_FPS)
+                    interval = 1.0 / fps if fps and fps > 0 else 0.0
+
+            ok, frame = capture.read()
+            if not ok:
+                capture.release()
+                capture = None
+                if not self.is_live:
+                    break
+                print(f"Lost video source {self.source}, reconnecting")
+                self._stop.wait(self.reconnect_delay)
+                continue
+
+            with self._cond:
+                if len(self.frames) == self.frames.maxlen:
+                    self.dropped += 1
+                self.frames.append((self.grabbed, time.time(), frame))
+                self.grabbed += 1
+                self._cond.notify()
+
+            if interval:
+                next_frame += interval
+                self._stop.wait(max(0.0, next_frame - time.monotonic()))
+
+        if capture is not None:
+            capture.release()
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+    def read(self, timeout=None):
+        """Oldest queued (index, timestamp, frame), or None on timeout/end of source"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.frames or self.finished, timeout)
+            return self.frames.popleft() if self.frames else None
+
+
+class AttendancePipeline:
+    """Passive attendance from one room camera for one section
+
+    Detection runs every detect_every processed frames (see FaceTracker);
+    a student is reported once their track has held the same identity
+    for confirm_frames frames.
+    """
+
+    def __init__(self, source, section_id, engine=None, detect_every=5, queue_size=4,
+                 threshold=FACE_GROUP_SIMILARITY_THRESHOLD, confirm_frames=None, mark=True,
+                 min_face_size=None):
+        self.section_id = section_id
+        self.mark = mark
+        self.confirm_frames = 2 * detect_every if confirm_frames is None else confirm_frames
+        self.grabber = FrameGrabber(source, queue_size)
+        self.tracker = FaceTracker(engine or get_face_engine(), detect_every=detect_every,
+                                   threshold=threshold, min_face_size=min_face_size)
+        self.reported = set()
+        # track_id -> (student_id, frame index the identity was first seen)
+        self._identities = {}
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def events(self):
+        """Process frames until the source ends or stop() is called, yielding attendance events"""
+        self.grabber.start()
+        try:
+            while not self._stop.is_set():
+                item = self.grabber.read(timeout=1.0)
+                if item is None:
+                    if self.grabber.finished:
+                        break
+                    continue
+                _, timestamp, frame = item
+                # Dictionary lookup; recompiled after enrollment or face changes
+                section = get_section_gallery(self.section_id)
+                self.tracker.gallery = section.gallery
+                tracks = self.tracker.update(frame)
+                yield from self._confirm(tracks, timestamp, section)
+        finally:
+            self.grabber.stop()
+
+    def _confirm(self, tracks, timestamp, section):
+        frame_index = self.tracker.frame_index
+        identities = {}
+        for track in tracks:
+            student_id = track['student_id']
+            if student_id is None:
+                continue
+            previous = self._identities.get(track['track_id'])
+            since = previous[1] if previous and previous[0] == student_id else frame_index
+            identities[track['track_id']] = (student_id, since)
+
+            if student_id in self.reported or frame_index - since < self.confirm_frames:
+                continue
+            self.reported.add(student_id)
+            marked = False
+            if self.mark:
+                marked = db.mark_attendance(student_id, self.section_id, 'present', track['similarity'])
+            yield {
+                'student_id': student_id,
+                'student': section.students.get(student_id),
+                'section_id': self.section_id,
+                'similarity': track['similarity'],
+                'track_id': track['track_id'],
+                'frame_index': frame_index,
+                'timestamp': datetime.fromtimestamp(timestamp),
+                'marked': marked
+            }
+        self._identities = identities
+
+    def stats(self):
+        return {
+            'grabbed': self.grabber.grabbed,
+            'dropped': self.grabber.dropped,
+            'reported': len(self.reported),
+            **self.tracker.stats
+        }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python video_pipeline.py <source> <section_id> [--dry-run]")
+        sys.exit(1)
+
+    pipeline = AttendancePipeline(sys.argv[1], int(sys.argv[2]), mark='--dry-run' not in sys.argv)
+    try:
+        for event in pipeline.events():
+            student = event['student']
+            name = f"{student[3]} {student[4]} ({student[2]})" if student else event['student_id']
+            print(f"{event['timestamp']:%H:%M:%S} present: {name} similarity={event['similarity']:.2f}")
+    except KeyboardInterrupt:
+        pipeline.stop()
+    print(pipeline.stats())